@@ -0,0 +1,346 @@
+# benchmark.py
+# بنچمارک مراحل پردازش آگهی‌ها روی داده‌ی messages.txt و cars_data.csv و پیکره‌های ساختگی بزرگ‌تر
+# بدون تلگرام اجرا می‌شه و خروجی JSON می‌ده تا نسخه‌ها رو بشه با هم مقایسه کرد:
+#   python benchmark.py --sizes 10000 100000 --output bench.json
+#   python benchmark.py --sizes 10000 --compare bench.json
+import argparse
+import asyncio
+import contextlib
+import itertools
+import csv
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import main
+
+SEED_MESSAGES = 'messages.txt'
+SEED_LISTINGS = 'cars_data.csv'
+
+BRAND_MODELS = {
+    'پراید': ['111', '131', '132', '151'],
+    'دنا': ['پلاس', 'پلاس توربو 6 دنده', 'اپشنال'],
+    '207': ['پانا', 'تیپ 2', 'اتومات'],
+    'جک': ['j4', 'j7', 's5'],
+    'فیدلیتی': ['پرستیژ', 'الیت'],
+    'دیگنیتی': ['پرایم', 'پرستیژ'],
+    'سورن': ['پلاس', 'ELX'],
+    'تارا': ['اتومات v4 تیتانیوم', 'دستی'],
+    'تویوتا': ['لوین 1200', 'کرولا'],
+    'کیا': ['سراتو', 'اسپورتیج'],
+    'هیوندای': ['النترا', 'توسان'],
+}
+COLORS = ['مشکی', 'سفید', 'خاکستری', 'قرمز', 'آبی', 'سبز', 'طلایی', 'مارون', 'تیتانیوم', 'سقف مشکی', 'طوسی']
+CONDITIONS = {
+    'بدنه': ['سالم', 'رنگ شده', 'تصادفی', 'تعویض'],
+    'شاسی': ['سالم', 'تعمیر شده', 'تعویض'],
+    'موتور': ['سالم', 'تعمیر شده', 'نیاز به تعمیر'],
+}
+EMOJI = ['🔥', '✅', '⚡️', '🚙', '❌', '🌹', '💯']
+PERSIAN_DIGITS = str.maketrans('0123456789', '۰۱۲۳۴۵۶۷۸۹')
+
+# داده‌ی نمونه: رکوردهای واقعی messages.txt و عنوان آگهی‌های cars_data.csv
+def load_seed():
+    records = list(main.iter_dump_records(SEED_MESSAGES))
+    with open(SEED_LISTINGS, encoding='utf-8-sig') as f:
+        titles = [row['model'] for row in csv.DictReader(f) if row.get('price')]
+    return records, titles
+
+# ساخت یک آگهی ساختگی شبیه آگهی‌های نمایشگاه‌ها (با ارقام فارسی یا انگلیسی)
+def synthesize_ad(rng, titles):
+    brand = rng.choice(list(BRAND_MODELS))
+    model = rng.choice(BRAND_MODELS[brand])
+    lines = [f"{rng.choice(EMOJI)} {brand} {model} {rng.choice(COLORS)} {rng.choice(['مدل ', 'سال ', ''])}"
+             f"{rng.randint(1390, 1404)} برج {rng.randint(1, 12)}"]
+    if rng.random() < 0.3:
+        lines.append(rng.choice(titles))
+    lines.append(f"کارکرد {rng.randint(0, 250) * 1000:,} کیلومتر")
+    for part, values in CONDITIONS.items():
+        if rng.random() < 0.6:
+            lines.append(f"{part} {rng.choice(values)}")
+    price = rng.randint(300, 9000)
+    lines.append(rng.choice([f"قیمت {price} میلیون", f"{price // 1000}/{price % 1000:03d}/000 تومان", f"{price}"]))
+    lines.append(f"09{rng.randint(100000000, 999999999)}")
+    text = '\n'.join(lines)
+    return text.translate(PERSIAN_DIGITS) if rng.random() < 0.5 else text
+
+# پیکره‌ی n پیامی: بیشترش آگهی ساختگی، بقیه رکوردهای واقعی (آگهی و غیرآگهی) با کمی تغییر
+def generate_corpus(n, seed=0):
+    rng = random.Random(seed)
+    records, titles = load_seed()
+    channels = sorted({channel for channel, _ in records})
+    corpus = []
+    for _ in range(n):
+        if rng.random() < 0.2:
+            channel, text = rng.choice(records)
+            text = f"{text}{rng.choice(EMOJI) * rng.randint(0, 3)}"
+        else:
+            channel, text = rng.choice(channels), synthesize_ad(rng, titles)
+        corpus.append((channel, text))
+    return corpus
+
+# جایگزین TelegramClient که پیام‌های پیکره رو مثل GetHistoryRequest صفحه‌به‌صفحه برمی‌گردونه
+# history برای هر کانال پیام‌ها رو به ترتیب شناسه نگه می‌داره (شناسه‌ی k در خونه‌ی k-1)، پس هر صفحه
+# با یک برش ساخته می‌شه و زمان fetch خطی می‌مونه
+class FakeTelegramClient:
+    history = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def start(self, **kwargs):
+        pass
+
+    async def get_entity(self, channel):
+        return channel
+
+    async def __call__(self, request):
+        messages = self.history.get(request.peer, [])
+        end = min(request.offset_id - 1, len(messages)) if request.offset_id else len(messages)
+        start = max(request.min_id, end - request.limit, 0)
+        # مثل تلگرام، جدیدترین پیام اول
+        return types.SimpleNamespace(messages=messages[start:end][::-1])
+
+def stub_telegram(corpus):
+    now = datetime.now(timezone.utc)
+    history = {}
+    for channel, text in corpus:
+        messages = history.setdefault(channel, [])
+        messages.append(types.SimpleNamespace(id=len(messages) + 1, message=text, date=now))
+    FakeTelegramClient.history = history
+    main.TelegramClient = FakeTelegramClient
+    main.GetHistoryRequest = lambda **kwargs: types.SimpleNamespace(**kwargs)
+    main.channel_list = list(history)
+    main.FETCH_MAX_DEPTH = max(len(messages) for messages in history.values())
+    main.FETCH_SINCE_DAYS = None
+
+# ذخیره‌ی پیام‌ها در یک پایگاه‌داده‌ی موقت تازه (هر اجرا فایل خودش رو داره): استخراج، درج آگهی‌ها،
+# گروه‌بندی تکراری‌ها و آمار قیمت. زمان dedup و price_stats از timed() خود main جدا ثبت می‌شه
+def store_stage(messages, directory, timings):
+    runs = itertools.count()
+
+    @contextlib.contextmanager
+    def recording(stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[-1][stage] = timings[-1].get(stage, 0) + time.perf_counter() - start
+
+    def store():
+        timings.append({})
+        db_path, db_local, timed = main.DB_PATH, main._db_local, main.timed
+        main.DB_PATH = os.path.join(directory, f"bench_{next(runs)}.db")
+        main._db_local, main.timed = threading.local(), recording
+        try:
+            return main.store_messages(messages)
+        finally:
+            main.DB_PATH, main._db_local, main.timed = db_path, db_local, timed
+    return store
+
+# اجرای یک مرحله و اندازه‌گیری زمان؛ اگه memory فعال باشه یک بار دیگه با tracemalloc برای
+# اندازه‌گیری بیشینه‌ی حافظه اجرا می‌شه (tracemalloc خودش زمان رو زیاد می‌کنه)
+def measure(stage, items, memory):
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+    report = {'seconds': round(seconds, 4), 'items': items,
+              'items_per_second': round(items / seconds, 1) if seconds else None}
+    if memory:
+        tracemalloc.start()
+        stage()
+        report['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    return result, report
+
+def run_pipeline(corpus, memory=True, queries=200):
+    stub_telegram(corpus)
+    results = {}
+
+    messages, results['fetch'] = measure(lambda: asyncio.run(main.fetch_messages({})), len(corpus), memory)
+
+    texts = [text for _, text in corpus]
+    _, results['classification'] = measure(lambda: main.filter_relevant(texts), len(texts), memory)
+
+    normalized = [main.normalize_text(text) for text in texts]
+    nlp, disabled = main.get_nlp()
+    docs = lambda: [main.spacy_brand(doc) for doc in nlp.pipe(
+        normalized, batch_size=main.SPACY_BATCH_SIZE, disable=disabled)]
+    brands, results['spacy'] = measure(docs, len(texts), memory)
+
+    fields, results['regex_extraction'] = measure(lambda: main.extract_fields_frame(normalized, brands), len(texts), memory)
+
+    rows = [main.frame_row_to_car(row) for _, row in fields.iterrows()]
+    listed = [i for i, car in enumerate(rows) if main.is_listing(car)]
+    cars = [rows[i] for i in listed]
+    df = pd.DataFrame(cars, columns=main.CAR_FIELDS)
+    (_, status), results['validation'] = measure(lambda: main.validate_frame(df), len(df), memory)
+    df['status'] = status
+
+    timings = []
+    with tempfile.TemporaryDirectory() as directory:
+        _, results['store'] = measure(store_stage(messages, directory, timings), len(messages), memory)
+    results['store'].update({f"{stage}_seconds": round(timings[0].get(stage, 0), 4) for stage in ('dedup', 'price_stats')})
+
+    df = df.assign(channel='bench', msg_id=np.arange(len(df)), posted_at=None, repost_count=1, channels='bench')
+    _, X = main.cluster_features(df)
+    model, results['clustering_fit'] = measure(lambda: main.build_cluster_model(X), len(X), memory)
+    _, results['clustering_predict'] = measure(
+        lambda: model['labels'][model['kmeans'].predict(model['scaler'].transform(X))], len(X), memory)
+    df['cluster'] = main.NO_CLUSTER
+    df = main.compact_listings(df.reindex(columns=main.LISTING_COLUMNS))
+
+    def build_search():
+        search = main.SearchIndex()
+        search.update([('bench', msg_id, f"{car.get('brand') or ''} {car.get('model') or ''}", texts[i])
+                       for msg_id, (i, car) in enumerate(zip(listed, cars))])
+        return search
+    search, results['search_index'] = measure(build_search, len(cars), memory)
+
+    listing_index, results['index_build'] = measure(lambda: main.ListingIndex(df, search=search), len(df), memory)
+    rng = random.Random(1)
+    filters = [main.parse_filters({
+        'brand': rng.choice([None, *BRAND_MODELS]),
+        'model': rng.choice([None, 'پلاس', 'j4', '131', 'تیپ']),
+        'max_price': str(rng.choice([1000, 3000, 10000])),
+        'min_year': str(rng.choice([0, 1395, 1400])),
+    }) for _ in range(queries)]
+    _, results['filtering'] = measure(lambda: [listing_index.query(f) for f in filters], queries, memory)
+    searches = [main.parse_filters({'q': rng.choice(['۲۰۶ تیپ ۲', 'پراید', 'دنا پلاس', 'سفيد ۱۴۰۲', 'توربو', 'کيا سراتو'])})
+                for _ in range(queries)]
+    _, results['text_search'] = measure(
+        lambda: [listing_index.rank(f['q'], listing_index.query(f)) for f in searches], queries, memory)
+
+    page = main.listing_records(df.head(main.PAGE_SIZE))
+    render = lambda: ''.join(main.page_template.generate(
+        cars=page, brands=list(listing_index.lookup['brand']), colors=list(listing_index.lookup['color']),
+        render_row=main.render_row, form={}, sorts=main.PAGE_SORTS, total=len(df), page=1, pages=1, page_url=lambda number: '', events_url=None,
+    ))
+    _, results['rendering'] = measure(render, len(page), memory)
+
+    results['summary'] = {'messages': len(corpus), 'relevant': len(messages), 'listings': len(df)}
+    return results
+
+# رشد زمان dedup با بزرگ شدن پایگاه‌داده: آگهی‌های یک نمایشگاه با متن ثابت مشترک (که همه در چند باند LSH
+# یکسان می‌افتن) دسته‌دسته با assign_duplicate_groups اضافه می‌شن. اگه کار هر آگهی ثابت باشه زمان دسته‌ها
+# تقریباً یکسان می‌مونه؛ growth نسبت زمان آخرین دسته به دومیه (دسته‌ی اول روی پایگاه‌داده‌ی خالی کاندیدایی نداره)
+DEALER_FOOTER = ("نمایشگاه اتو مهر با ضمانت و تخفیف ویژه و اقساط بدون ضامن، تحویل فوری در محل نمایشگاه، "
+                 "آدرس تهران خیابان آزادی پلاک ۱۲ ساعت کاری ۹ تا ۲۱ همه روزه")
+
+def dedup_growth(batches, batch_size, seed=0):
+    rng = random.Random(seed)
+    seconds = []
+    db_path, db_local = main.DB_PATH, main._db_local
+    with tempfile.TemporaryDirectory() as directory:
+        main.DB_PATH = os.path.join(directory, 'bench_dedup.db')
+        main._db_local = threading.local()
+        try:
+            conn = main.get_db()
+            for batch in range(batches):
+                entries = []
+                for msg_id in range(batch * batch_size + 1, (batch + 1) * batch_size + 1):
+                    brand = rng.choice(list(BRAND_MODELS))
+                    car = {'brand': brand, 'model': rng.choice(BRAND_MODELS[brand]), 'color': rng.choice(COLORS),
+                           'year': rng.randint(1390, 1404), 'price': float(rng.randint(300, 9000))}
+                    text = (f"{rng.choice(EMOJI)} {car['brand']} {car['model']} {car['color']} مدل {car['year']}\n"
+                            f"قیمت {int(car['price'])} میلیون\n{DEALER_FOOTER}")
+                    entries.append(('dealer', msg_id, text, car))
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO listings (channel, msg_id, content_hash, raw_text, is_listing, "
+                        + ", ".join(main.DEDUP_FIELDS) + ") VALUES (?, ?, ?, ?, 1" + ", ?" * len(main.DEDUP_FIELDS) + ")",
+                        [(channel, msg_id, main.content_hash(text), text) + tuple(car[field] for field in main.DEDUP_FIELDS)
+                         for channel, msg_id, text, car in entries]
+                    )
+                    start = time.perf_counter()
+                    main.assign_duplicate_groups(conn, entries)
+                    seconds.append(round(time.perf_counter() - start, 4))
+                print(f"dedup دسته‌ی {batch + 1}: {seconds[-1]:.2f}s")
+            conn.close()
+        finally:
+            main.DB_PATH, main._db_local = db_path, db_local
+    return {'batch_size': batch_size, 'seconds': seconds,
+            'growth': round(seconds[-1] / seconds[min(1, len(seconds) - 1)], 2)}
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+# مقایسه با یک خروجی قبلی؛ مراحلی که بیشتر از threshold برابر کندتر شدن گزارش می‌شن
+def compare(report, baseline_path, threshold):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    for size, stages in report['sizes'].items():
+        for stage, current in stages.items():
+            previous = baseline.get('sizes', {}).get(size, {}).get(stage)
+            if not previous or 'seconds' not in current or not previous.get('seconds'):
+                continue
+            ratio = current['seconds'] / previous['seconds']
+            marker = 'کندتر' if ratio > threshold else ''
+            print(f"{size:>9} {stage:<20} {previous['seconds']:>9.4f}s -> {current['seconds']:>9.4f}s  x{ratio:.2f} {marker}")
+            if ratio > threshold:
+                regressions.append((size, stage, ratio))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="بنچمارک مراحل پردازش آگهی‌ها")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000], help="تعداد پیام‌های پیکره‌ی ساختگی")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help="بدون اندازه‌گیری حافظه (سریع‌تر)")
+    parser.add_argument('--output', help="فایل JSON خروجی")
+    parser.add_argument('--compare', help="خروجی JSON قبلی برای مقایسه")
+    parser.add_argument('--threshold', type=float, default=1.2, help="نسبت کندی که پسرفت حساب می‌شه")
+    parser.add_argument('--dedup-batches', type=int, default=6, help="تعداد دسته‌های آزمون رشد dedup (0 یعنی اجرا نشه)")
+    parser.add_argument('--dedup-batch-size', type=int, default=1000)
+    parser.add_argument('--max-dedup-growth', type=float, default=2.0,
+                        help="بیشترین نسبت زمان آخرین دسته‌ی dedup به دومی")
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'sizes': {},
+    }
+    for size in args.sizes:
+        print(f"اجرای بنچمارک با {size} پیام...")
+        report['sizes'][str(size)] = run_pipeline(generate_corpus(size, args.seed), memory=not args.no_memory)
+    if args.dedup_batches:
+        print("اجرای آزمون رشد dedup...")
+        report['dedup_growth'] = dedup_growth(args.dedup_batches, args.dedup_batch_size, args.seed)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = bool(args.compare and compare(report, args.compare, args.threshold))
+    growth = report.get('dedup_growth', {}).get('growth')
+    if growth is not None and growth > args.max_dedup_growth:
+        print(f"زمان dedup با بزرگ شدن داده {growth} برابر شد (سقف: {args.max_dedup_growth})")
+        failed = True
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,100 @@
+# check_price_stats.py
+# بررسی آمار قیمت افزایشی: پیام‌های ساختگی چند دسته‌ای (آگهی جدید، ویرایش قیمت، آگهی فروش‌رفته، بازنشر
+# در کانال‌های دیگه و بازنشری که قبل از آگهی اصلی می‌رسه) با store_messages ذخیره می‌شن و جدول‌های آمار
+# باید دقیقاً همونی بشن که rebuild_price_stats (python main.py prices) از اول می‌سازه. روی یک پایگاه‌داده‌ی موقت اجرا می‌شه:
+#   python check_price_stats.py
+#   python check_price_stats.py --messages 2000 --batches 10 --seed 3
+import argparse
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import benchmark
+import main
+
+# وضعیت کامل جدول‌های آمار (مجموع قیمت‌ها گرد می‌شن تا خطای جمع و تفریق اعشاری دیده نشه)
+def price_tables(conn):
+    stats = {tuple(row[:3]): (row[3], round(row[4], 6), row[5])
+             for row in conn.execute("SELECT brand, model, year, count, total, sketch FROM price_stats")}
+    trends = {tuple(row[:4]): (row[4], round(row[5], 6))
+              for row in conn.execute("SELECT brand, model, year, week, count, total FROM price_trends")}
+    return stats, trends
+
+def report_differences(name, incremental, rebuilt):
+    differences = 0
+    for key in sorted(set(incremental) | set(rebuilt), key=repr):
+        if incremental.get(key) != rebuilt.get(key):
+            differences += 1
+            if differences <= 10:
+                print(f"  {name} {key}: افزایشی={incremental.get(key)} از اول={rebuilt.get(key)}")
+    return differences
+
+def run_check(messages, batches, seed):
+    rng = random.Random(seed)
+    _, titles = benchmark.load_seed()
+    channels = [f"channel_{i}" for i in range(4)]
+    next_id = dict.fromkeys(channels, 0)
+    posted = {}
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    def new_message(channel, text, date=None):
+        next_id[channel] += 1
+        key = (channel, next_id[channel])
+        posted[key] = date or start + timedelta(hours=len(posted))
+        return key + (posted[key], text)
+
+    delayed = []
+    for batch in range(batches):
+        pending, delayed = delayed, []
+        for _ in range(messages // batches):
+            roll = rng.random()
+            if posted and roll < 0.15:
+                # ویرایش یک پیام قبلی با قیمت و مشخصات تازه
+                channel, msg_id = rng.choice(list(posted))
+                pending.append((channel, msg_id, posted[(channel, msg_id)], benchmark.synthesize_ad(rng, titles)))
+            elif posted and roll < 0.2:
+                channel, msg_id = rng.choice(list(posted))
+                pending.append((channel, msg_id, posted[(channel, msg_id)], "فروش رفت، ممنون از همراهی شما 🌹"))
+            elif posted and roll < 0.35:
+                # بازنشر همون آگهی با ایموجی و شماره‌ی دیگه در یک کانال دیگه
+                text = main.get_db().execute("SELECT raw_text FROM listings WHERE is_listing = 1 "
+                                             "ORDER BY RANDOM() LIMIT 1").fetchone()
+                if text:
+                    pending.append(new_message(rng.choice(channels), f"{rng.choice(benchmark.EMOJI)} {text[0]}\n"
+                                                                      f"09{rng.randint(100000000, 999999999)}"))
+            elif roll < 0.45:
+                # بازنشری که قبل از آگهی اصلی (با تاریخ چند هفته زودتر در یک کانال دیگه) می‌رسه؛ آگهی اصلی
+                # یا در همین دسته بعد از بازنشر ذخیره می‌شه یا در دسته‌ی بعد
+                text = benchmark.synthesize_ad(rng, titles)
+                repost, original = rng.sample(channels, 2)
+                date = start + timedelta(hours=len(posted))
+                pending.append(new_message(repost, f"{text}\n{rng.choice(benchmark.EMOJI)}", date + timedelta(weeks=5)))
+                (pending if rng.random() < 0.5 else delayed).append(new_message(original, text, date))
+            else:
+                pending.append(new_message(rng.choice(channels), benchmark.synthesize_ad(rng, titles)))
+        # هر پیام فقط یک بار در هر دسته (آخرین نسخه) و مثل دریافت از تلگرام کانال به کانال، جدیدترین اول
+        pending = {(channel, msg_id): (channel, msg_id, date, text) for channel, msg_id, date, text in pending}
+        main.store_messages(sorted(pending.values(), key=lambda message: (message[0], -message[2].timestamp())))
+        print(f"دسته‌ی {batch + 1} از {batches}: {len(pending)} پیام")
+
+    conn = main.get_db()
+    incremental = price_tables(conn)
+    main.rebuild_price_stats()
+    rebuilt = price_tables(conn)
+    differences = (report_differences('price_stats', incremental[0], rebuilt[0])
+                   + report_differences('price_trends', incremental[1], rebuilt[1]))
+    print(f"{len(rebuilt[0])} گروه قیمت و {len(rebuilt[1])} ردیف روند؛ اختلاف: {differences}")
+    return differences
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="مقایسه‌ی آمار قیمت افزایشی با ساختن از اول")
+    parser.add_argument('--messages', type=int, default=1000, help="تعداد کل پیام‌ها")
+    parser.add_argument('--batches', type=int, default=8, help="تعداد دسته‌های store_messages")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        main.DB_PATH = os.path.join(directory, 'check_price_stats.db')
+        if run_check(args.messages, args.batches, args.seed):
+            raise SystemExit(1)
@@ -0,0 +1,108 @@
+# check_search_index.py
+# بررسی ایندکس متنی (SearchIndex) با تکه‌ها و ادغامشون: دسته‌های تصادفی آگهی جدید، ویرایش و حذف به
+# ایندکس داده می‌شن و بعد از هر چند دسته نتیجه‌ی match برای چند جستجو با جستجوی مستقیم روی متن‌ها
+# (بدون ایندکس) مقایسه می‌شه. ترتیب و اندازه‌ی تکه‌ها و تعداد آگهی‌های هر کلمه هم بررسی می‌شه:
+#   python check_search_index.py
+#   python check_search_index.py --batches 1000 --seed 3
+import argparse
+import collections
+import math
+import random
+
+import numpy as np
+
+import main
+
+WORDS = ['پراید', 'دنا', 'پلاس', 'توربو', 'پلاستوربو', 'سفید', 'سفيد', 'مشکی', 'تیپ', '2', '206', '۱۴۰۲', '1402',
+         'j4', 'J7', 'كيا', 'سراتو', 'می‌خواهم', 'ی', 'ـپژوـ', 'قیمت', '09123456789']
+QUERIES = ['پلاس', 'توربو', 'تیپ 2', 'کیا', 'می خواهم', '206 سفید', 'ی', 'j', 'پژو', '۱۴۰۲ سفيد', '0912', 'پلاس توربو']
+
+# جستجوی مستقیم روی کلمه‌های عنوان و متن هر آگهی: هر کلمه‌ی جستجو باید با یکی از اون‌ها بخونه
+# (عدد و کلمه‌ی کوتاه دقیقاً، بقیه به صورت بخشی از کلمه)
+def brute_force(documents, query):
+    tokens = main.search_normalize(query).split()
+    matched = set()
+    for key, terms in documents.items():
+        if all(any(term == token if token.isdigit() or len(token) < main.MODEL_NGRAM else token in term
+                   for term in terms) for token in tokens):
+            matched.add(key)
+    return matched
+
+# تکه‌ها از قدیمی به جدید کوچیک‌تر می‌شن (هر تکه بیشتر از SEARCH_MERGE_RATIO برابر بعدی) و آگهی‌های هر کلمه
+# در هر تکه مرتب و بزرگ‌تر از آگهی‌های تکه‌های قبلی‌ان
+def check_segments(index):
+    problems = []
+    sizes = [len(docs) for _, docs, _ in index.segments]
+    for older, newer in zip(sizes, sizes[1:]):
+        if newer * main.SEARCH_MERGE_RATIO >= older:
+            problems.append(f"تکه‌ها ادغام نشدن: {sizes}")
+            break
+    if len(sizes) > math.log(max(sum(sizes), 1), main.SEARCH_MERGE_RATIO) + 2:
+        problems.append(f"تعداد تکه‌ها زیاده: {sizes}")
+    previous_max = -1
+    for offsets, docs, weights in index.segments:
+        if len(docs) != len(weights) or offsets[-1] != len(docs):
+            problems.append("اندازه‌ی آرایه‌های تکه با هم نمی‌خونه")
+        for term in range(len(offsets) - 1):
+            postings = docs[offsets[term]:offsets[term + 1]]
+            if len(postings) > 1 and not np.all(np.diff(postings) > 0):
+                problems.append(f"آگهی‌های کلمه‌ی {index.term_names[term]} مرتب نیستن")
+                break
+        if len(docs) and docs.min() <= previous_max:
+            problems.append("آگهی‌های یک تکه از تکه‌ی قبلی کوچیک‌تر نیستن")
+        previous_max = max(previous_max, int(docs.max()) if len(docs) else -1)
+    return problems
+
+def run_check(batches, every, seed):
+    rng = random.Random(seed)
+    index = main.SearchIndex()
+    documents = {}
+    failures = 0
+    for batch in range(batches):
+        entries = []
+        # اندازه‌ی دسته‌ها خیلی فرق می‌کنه تا ادغام‌های زنجیره‌ای هم پیش بیاد
+        for _ in range(rng.choice([1, 3, 10, 40, 200])):
+            key = (f"channel_{rng.randint(0, 2)}", rng.randint(1, 400))
+            if rng.random() < 0.15:
+                entries.append(key + ('', None))
+                documents.pop(key, None)
+            else:
+                title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 2)))
+                text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+                entries.append(key + (title, text))
+                documents[key] = main.search_terms(title) | main.search_terms(text)
+        index.update(entries)
+
+        if batch % every and batch != batches - 1:
+            continue
+        problems = check_segments(index)
+        # تعداد آگهی‌های هر کلمه (برای idf) فقط آگهی‌های فعلی رو می‌شمره، نه نسخه‌های قبلی یا حذف‌شده‌ها
+        frequencies = collections.Counter(term for terms in documents.values() for term in terms)
+        wrong = sum(int(index.counts[term_id]) != frequencies.get(term, 0) for term, term_id in index.terms.items())
+        if wrong:
+            problems.append(f"تعداد آگهی‌های {wrong} کلمه اشتباهه")
+        for query in QUERIES:
+            docs, scores = index.match(query)
+            found = {int(key) for key in index.doc_keys[docs]}
+            expected = {index._key(*key) for key in brute_force(documents, query)}
+            if found != expected:
+                problems.append(f"جستجوی «{query}»: {len(found - expected)} اضافه و {len(expected - found)} جاافتاده")
+            if len(scores) != len(docs) or (len(scores) and not np.all(scores > 0)):
+                problems.append(f"امتیازهای جستجوی «{query}» نامعتبرن")
+        for problem in problems:
+            print(f"  دسته‌ی {batch + 1}: {problem}")
+        failures += len(problems)
+
+    sizes = [len(docs) for _, docs, _ in index.segments]
+    print(f"{len(documents)} آگهی، {len(index.terms)} کلمه، تکه‌ها: {sizes}؛ خطا: {failures}")
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="مقایسه‌ی ایندکس متنی تکه‌ای با جستجوی مستقیم")
+    parser.add_argument('--batches', type=int, default=400, help="تعداد دسته‌های update")
+    parser.add_argument('--every', type=int, default=10, help="هر چند دسته یک بار بررسی بشه")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if run_check(args.batches, args.every, args.seed):
+        raise SystemExit(1)
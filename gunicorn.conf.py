@@ -0,0 +1,40 @@
+# gunicorn.conf.py
+# اجرای چند پروسه‌ی وب که فقط از پایگاه‌داده‌ی آگهی‌ها می‌خونن و هیچ‌وقت به تلگرام وصل نمی‌شن.
+# دریافت پیام‌ها فقط در یک پروسه‌ی جدا انجام می‌شه:
+#   python main.py fetcher            (یا python main.py fetcher --live)
+# متریک‌های دریافت مال پروسه‌ی fetcher هستن؛ یا با همون METRICS_DIR workerها در /metrics وب جمع می‌شن
+# یا جدا روی یک پورت دیگه (فقط یکی از این دو رو scrape کنید تا counterها دو بار شمرده نشن):
+#   METRICS_DIR=/tmp/car_filter_metrics python main.py fetcher
+#   python main.py fetcher --metrics-port 9101
+#   gunicorn -c gunicorn.conf.py main:app
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# هر stream باز /events یک thread رو نگه می‌داره؛ main.SSE_MAX_STREAMS (پیش‌فرض ۸) سقف streamهای هر
+# worker است تا بقیه‌ی threadها برای صفحه و API بمونن، پس THREADS باید ازش بیشتر باشه
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 16))
+timeout = 60
+# هر worker مدل‌ها و جدول آگهی‌ها رو خودش بارگذاری می‌کنه؛ preload باعث می‌شد اتصال‌های SQLite
+# و threadهای پروسه‌ی اصلی بین workerها به اشتراک گذاشته بشن
+preload_app = False
+
+# هر worker متریک‌های خودش رو داره؛ workerها متریک‌هاشون رو در METRICS_DIR می‌نویسن و /metrics هر
+# workerی که جواب بده جمع همه رو برمی‌گردونه (gaugeها با برچسب pid برای هر worker). پوشه موقع شروع
+# gunicorn خالی می‌شه تا فایل workerهای اجرای قبلی جمع نشن
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'car_filter_metrics'))
+
+def on_starting(server):
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['METRICS_DIR'], exist_ok=True)
+
+# گرم کردن worker قبل از اولین درخواست (/ready تا پایانش 503 برمی‌گردونه)؛ workerها دریافت نمی‌کنن،
+# پس مدل دسته‌بندی و spaCy رو بارگذاری نمی‌کنن
+def post_worker_init(worker):
+    import main
+    main.start_metrics_writer()
+    main.start_warm_up()
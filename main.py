@@ -1,21 +1,62 @@
 # main.py
-from flask import Flask, request, render_template_string
+from flask import Flask, request, jsonify, Response, stream_with_context, url_for, g, has_request_context
+from markupsafe import Markup
 import re
-import pandas as pd
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from telethon.sync import TelegramClient
-from telethon.tl.functions.messages import GetHistoryRequest
+import argparse
 import asyncio
-import nest_asyncio
+import base64
+import collections
+import contextlib
+from datetime import datetime, timedelta, timezone
+import functools
+import hashlib
+import importlib
+import json
+import math
+import multiprocessing
 import os
-import spacy
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.svm import SVC
+import sqlite3
+import threading
+import subprocess
+import sys
+import time
+import zlib
 import pickle
+import socket
+import atexit
+import signal
 
 os.environ["LOKY_MAX_CPU_COUNT"] = "4"
-nest_asyncio.apply()
+
+# کتابخونه‌های سنگین (pandas، scikit-learn، Telethon، spaCy) موقع import این فایل بارگذاری نمی‌شن؛
+# اولین استفاده یا warm_up() اون‌ها رو import می‌کنه تا پروسه‌ها سریع بالا بیان
+class LazyImport:
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+np = LazyImport('numpy')
+pd = LazyImport('pandas')
+spacy = LazyImport('spacy')
+MiniBatchKMeans = LazyImport('sklearn.cluster', 'MiniBatchKMeans')
+StandardScaler = LazyImport('sklearn.preprocessing', 'StandardScaler')
+TfidfVectorizer = LazyImport('sklearn.feature_extraction.text', 'TfidfVectorizer')
+SVC = LazyImport('sklearn.svm', 'SVC')
+TelegramClient = LazyImport('telethon.sync', 'TelegramClient')
+GetHistoryRequest = LazyImport('telethon.tl.functions.messages', 'GetHistoryRequest')
 
 app = Flask(__name__)
 
@@ -25,8 +66,231 @@ API_HASH =
 PHONE = 
 channel_list = 
 
-# بارگذاری مدل زبان فارسی spaCy
-nlp = spacy.load("fa_core_news_sm")
+# تنظیمات دریافت دوره‌ای پیام‌ها
+FETCH_INTERVAL = 300  # فاصله‌ی بین دو نوبت دریافت (ثانیه)
+FETCH_LIMIT = 100  # تعداد پیام در هر صفحه‌ی GetHistoryRequest
+FETCH_MAX_DEPTH = 1000  # حداکثر تعداد پیام از هر کانال در اولین دریافت (بدون watermark)
+FETCH_SINCE_DAYS = 30  # پیام‌های قدیمی‌تر از این گرفته نمی‌شن (None یعنی بدون محدودیت)
+FETCH_CONCURRENCY = 8  # تعداد کانال‌هایی که همزمان گرفته می‌شن
+FLOOD_WAIT_RETRIES = 3
+
+# حالت زنده: به جای دریافت دوره‌ای، پیام‌های جدید کانال‌ها همون لحظه از تلگرام گرفته می‌شن
+# (python main.py serve --live)
+LIVE_MODE = False
+LIVE_BATCH_WINDOW = 2  # پیام‌هایی که در این چند ثانیه می‌رسن با هم پردازش می‌شن
+LIVE_RETRY_INTERVAL = 30  # فاصله‌ی تلاش دوباره بعد از قطع شدن اتصال (ثانیه)
+
+# مسیر پایگاه‌داده‌ی محلی آگهی‌ها؛ با WAL چند پروسه‌ی وب همزمان با پروسه‌ی دریافت ازش می‌خونن
+DB_PATH = 'listings.db'
+DB_BUSY_TIMEOUT = 30  # چند ثانیه منتظر قفل نوشتن بمونه (به جای خطای database is locked)
+
+# فقط یک پروسه اجازه‌ی دریافت از تلگرام رو داره (فایل session مشترکه)؛ مالکیت با یک lease در
+# پایگاه‌داده مشخص می‌شه که هر FETCHER_LEASE_TTL/3 ثانیه تمدید می‌شه
+FETCHER_LEASE_TTL = 60
+
+# مسیر فایل‌های مدل دسته‌بندی پیام‌ها
+CLASSIFIER_PATH = 'channel_classifier.pkl'
+VECTORIZER_PATH = 'vectorizer.pkl'
+
+# متریک‌ها به قالب Prometheus (مسیر /metrics)؛ زمان هر مرحله، تعداد پیام‌ها و خطاهای هر کانال،
+# نتیجه‌ی دسته‌بندی، نرخ پیدا شدن هر فیلد و استفاده از cacheها
+METRICS_TIMING_HEADERS = True  # افزودن هدر Server-Timing به پاسخ‌ها
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# هر پروسه (مثلاً هر worker در gunicorn) متریک‌های خودش رو داره، پس بدون این تنظیم /metrics فقط مال
+# workerیه که جواب داده. با METRICS_DIR هر پروسه هر METRICS_FLUSH_INTERVAL ثانیه (و موقع خروج) متریک‌هاش
+# رو در <METRICS_DIR>/<pid>.json می‌نویسه و /metrics همه‌ی فایل‌ها رو با هم جمع می‌زنه: counterها و
+# histogramها جمع همه‌ی پروسه‌ها (حتی پروسه‌های تموم‌شده) و gaugeها جدا برای هر پروسه‌ی زنده با برچسب pid
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_FLUSH_INTERVAL = 5
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.types = {}
+        self.values = collections.defaultdict(dict)
+
+    def describe(self, name, kind, text):
+        self.types[name] = kind
+        self.help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.values[name].get(key)
+            if histogram is None:
+                histogram = self.values[name][key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def _labels(key, **extra):
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def dump(self):
+        with self.lock:
+            return json.dumps({name: [[key, value] for key, value in series.items()]
+                               for name, series in self.values.items()})
+
+    def write(self, directory):
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.dump())
+        os.replace(path + '.tmp', path)
+
+    # متریک‌های این پروسه (همین الان) به‌علاوه‌ی آخرین فایل پروسه‌های دیگه در directory
+    def collect(self, directory):
+        sources = [(os.getpid(), True, json.loads(self.dump()))]
+        for filename in os.listdir(directory):
+            pid = filename[:-len('.json')]
+            if not filename.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    sources.append((int(pid), not process_dead(int(pid)), json.load(f)))
+            except (OSError, ValueError):
+                continue
+        combined = collections.defaultdict(dict)
+        for pid, alive, values in sources:
+            for name, series in values.items():
+                kind = self.types.get(name, 'untyped')
+                for key, value in series:
+                    key = tuple(map(tuple, key))
+                    if kind == 'gauge':
+                        if alive:
+                            combined[name][key + (('pid', pid),)] = value
+                    elif kind == 'histogram':
+                        total = combined[name].setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0,
+                                                                'count': 0})
+                        total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+                        total['sum'] += value['sum']
+                        total['count'] += value['count']
+                    else:
+                        combined[name][key] = combined[name].get(key, 0) + value
+        return combined
+
+    def render(self):
+        if METRICS_DIR and os.path.isdir(METRICS_DIR):
+            values = self.collect(METRICS_DIR)
+        else:
+            values = {name: {tuple(map(tuple, key)): value for key, value in series}
+                      for name, series in json.loads(self.dump()).items()}
+        lines = []
+        for name in sorted(values):
+            kind = self.types.get(name, 'untyped')
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in values[name].items():
+                if kind == 'histogram':
+                    for bound, count in zip(LATENCY_BUCKETS, value['buckets']):
+                        lines.append(f"{name}_bucket{self._labels(key, le=bound)} {count}")
+                    lines.append(f"{name}_bucket{self._labels(key, le='+Inf')} {value['count']}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{self._labels(key)} {value['count']}")
+                else:
+                    lines.append(f"{name}{self._labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def process_dead(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+# نوشتن دوره‌ای متریک‌های این پروسه در METRICS_DIR (اگه تنظیم شده باشه)
+def start_metrics_writer():
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                metrics.write(METRICS_DIR)
+            except OSError as e:
+                print(f"خطا در نوشتن متریک‌ها: {e}")
+
+    metrics.write(METRICS_DIR)
+    atexit.register(metrics.write, METRICS_DIR)
+    threading.Thread(target=run, name='metrics-writer', daemon=True).start()
+metrics.describe('car_filter_stage_seconds', 'histogram', "زمان اجرای هر مرحله‌ی پردازش")
+metrics.describe('car_filter_request_seconds', 'histogram', "زمان پاسخ به درخواست‌های وب")
+metrics.describe('car_filter_fetched_messages_total', 'counter', "تعداد پیام‌های گرفته‌شده از هر کانال")
+metrics.describe('car_filter_fetch_errors_total', 'counter', "تعداد خطاهای گرفتن پیام از هر کانال")
+metrics.describe('car_filter_flood_waits_total', 'counter', "تعداد FloodWaitهای تلگرام برای هر کانال")
+metrics.describe('car_filter_classifier_decisions_total', 'counter', "نتیجه‌ی دسته‌بندی پیام‌ها (مرتبط/غیرمرتبط)")
+metrics.describe('car_filter_extracted_messages_total', 'counter', "تعداد پیام‌هایی که استخراج روشون اجرا شد")
+metrics.describe('car_filter_extracted_fields_total', 'counter', "تعداد دفعاتی که هر فیلد از متن پیدا شد")
+metrics.describe('car_filter_duplicates_total', 'counter', "تعداد آگهی‌هایی که بازنشر یک آگهی قبلی تشخیص داده شدن")
+metrics.describe('car_filter_cache_requests_total', 'counter', "مراجعه به cacheها به تفکیک نتیجه")
+metrics.describe('car_filter_listings', 'gauge', "تعداد آگهی‌های نسخه‌ی فعلی داده")
+metrics.describe('car_filter_price_buckets', 'gauge', "تعداد گروه‌های (برند، مدل، سال) در آمار قیمت")
+metrics.describe('car_filter_search_terms', 'gauge', "تعداد کلمه‌های ایندکس جستجوی متنی")
+metrics.describe('car_filter_listings_bytes', 'gauge', "حافظه‌ی جدول آگهی‌های نسخه‌ی فعلی")
+metrics.describe('car_filter_data_version', 'gauge', "نسخه‌ی فعلی داده")
+metrics.describe('car_filter_ready', 'gauge', "۱ وقتی گرم کردن پروسه تموم شده باشه")
+metrics.describe('car_filter_sse_streams', 'gauge', "تعداد streamهای باز /events در این پروسه")
+metrics.describe('car_filter_sse_rejected_total', 'counter', "درخواست‌های /events که به خاطر پر بودن ظرفیت 503 گرفتن")
+
+# اندازه‌گیری زمان یک مرحله؛ داخل درخواست وب برای هدر Server-Timing هم ثبت می‌شه
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('car_filter_stage_seconds', elapsed, stage=stage)
+        if has_request_context():
+            g.setdefault('timings', []).append((stage, elapsed))
+
+# مدل زبان فارسی spaCy در اولین استفاده بارگذاری می‌شه
+SPACY_MODEL = "fa_core_news_sm"
+# فقط موجودیت‌ها (doc.ents) لازم داریم؛ بقیه‌ی اجزای pipeline موقع پردازش غیرفعال می‌شن
+SPACY_KEEP = ('tok2vec', 'ner')
+SPACY_BATCH_SIZE = 256
+SPACY_N_PROCESS = 1  # برای پردازش‌های حجیم (backfill) می‌شه بیشتر گذاشت
+
+nlp_lock = threading.Lock()
+_nlp_state = {'nlp': None, 'disabled': []}
+
+# مدل spaCy و لیست اجزایی که باید غیرفعال بشن
+def get_nlp():
+    with nlp_lock:
+        if _nlp_state['nlp'] is None:
+            with timed('spacy_load'):
+                nlp = spacy.load(SPACY_MODEL)
+            _nlp_state.update(nlp=nlp, disabled=[name for name in nlp.pipe_names if name not in SPACY_KEEP])
+        return _nlp_state['nlp'], _nlp_state['disabled']
+
+# نسخه‌ی قواعد استخراج؛ الگوهای جدول قواعد خودشون جزو کلید cache هستن (extractor_fingerprint)،
+# ولی با تغییر کد استخراج (مثل scale_price) این باید زیاد بشه تا cache استخراج قدیمی استفاده نشه
+EXTRACTOR_VERSION = 2
+# با False استخراج نه از cache می‌خونه نه توش می‌نویسه (replay --no-cache)
+EXTRACTION_CACHE = True
 
 # دیتاست ساده برای ترینیگ دسته‌بندی کانال‌ها
 training_data = [
@@ -37,21 +301,25 @@ training_data = [
     ("فروش گوشی سامسونگ مدل A52 قیمت ۵ میلیون", "غیرمرتبط"),
 ]
 
-# آماده‌سازی داده‌های ترینیگ
-texts, labels = zip(*training_data)
-vectorizer = TfidfVectorizer()
-X_train = vectorizer.fit_transform(texts)
-y_train = labels
-
-# ترینیگ مدل SVM
-classifier = SVC(kernel='linear')
-classifier.fit(X_train, y_train)
+# ترینیگ مدل SVM روی دیتاست بالا
+def build_classifier():
+    texts, labels = zip(*training_data)
+    vectorizer = TfidfVectorizer()
+    X_train = vectorizer.fit_transform(texts)
+    classifier = SVC(kernel='linear')
+    classifier.fit(X_train, labels)
+    return vectorizer, classifier
 
-# ذخیره مدل و vectorizer برای استفاده بعدی
-with open('channel_classifier.pkl', 'wb') as f:
-    pickle.dump(classifier, f)
-with open('vectorizer.pkl', 'wb') as f:
-    pickle.dump(vectorizer, f)
+# ترینیگ آفلاین و ذخیره‌ی مدل (python main.py train)؛ فایل‌ها اول موقت نوشته و بعد جایگزین می‌شن
+# تا پروسه‌ای که همزمان داره می‌خونه فایل نصفه نبینه
+def train_classifier():
+    vectorizer, classifier = build_classifier()
+    for path, obj in ((VECTORIZER_PATH, vectorizer), (CLASSIFIER_PATH, classifier)):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmp_path, path)
+    print(f"مدل دسته‌بندی در {CLASSIFIER_PATH} و {VECTORIZER_PATH} ذخیره شد")
 
 # تابع برای فرمت کردن قیمت
 def format_price(price):
@@ -61,237 +329,2225 @@ def format_price(price):
     price_str = f"{price:,}".replace(",", ".")
     return f"{price_str} تومن"
 
-# تابع اعتبارسنجی داده‌ها
-def validate_data(car):
-    status = "درست"
-    
-    if 'year' in car and not pd.isna(car['year']):
-        year = car['year']
-        if not (1370 <= year <= 1404 or 2000 <= year <= 2025):
-            status = "مشکوک: سال خارج از محدوده (1370-1404 یا 2000-2025)"
-
-    if 'price' in car and not pd.isna(car['price']):
-        price = car['price']
-        if not (50 <= price <= 10000):
-            status = "مشکوک: قیمت خارج از محدوده (50M-10B)"
-
-    if 'brand' in car and 'model' in car and not pd.isna(car['brand']) and not pd.isna(car['model']):
-        brand = car['brand'].lower()
-        model = car['model'].lower()
-        valid_models = {
-            'پراید': ['111', '131', '132', '151'],
-            'دنا': ['پلاس', 'توربو', 'پلاس توربو 6 دنده'],
-            '207': ['پانا', 'پانامرا', 'تیپ'],
-            'دیگنیتی': ['پرایم'],
-            'جک': ['j4', 'j7'],
-            'فیدلیتی': ['پرستیژ', 'داخل طوسی 5 نفره'],
-            'سورن': ['پلاس'],
-            'تارا': ['اتومات v4 تیتانیوم'],
-            'تویوتا': ['لوین 1200']
-        }
-        if brand in valid_models and not any(m in model for m in valid_models[brand]):
-            status = "مشکوک: مدل با برند تطابق ندارد"
+# قواعد اعتبارسنجی داده‌ها؛ هر قاعده روی یک ستون کل دسته‌ی آگهی‌ها با هم اعمال می‌شه
+# range: مقدار ستون باید داخل یکی از بازه‌ها باشه (مقدار خالی بررسی نمی‌شه)
+# whitelist: برای برندهای داخل allowed، مدل باید شامل یکی از مدل‌های مجاز باشه
+# برای تغییر قواعد بدون تغییر کد، همین ساختار رو در validation_rules.json بذارید
+VALIDATION_RULES_PATH = 'validation_rules.json'
+DEFAULT_VALIDATION_RULES = [
+    {'name': 'year', 'kind': 'range', 'column': 'year', 'ranges': [[1370, 1404], [2000, 2025]],
+     'message': "سال خارج از محدوده (1370-1404 یا 2000-2025)"},
+    {'name': 'price', 'kind': 'range', 'column': 'price', 'ranges': [[50, 10000]],
+     'message': "قیمت خارج از محدوده (50M-10B)"},
+    {'name': 'brand_model', 'kind': 'whitelist', 'column': 'model', 'key': 'brand',
+     'allowed': {
+         'پراید': ['111', '131', '132', '151'],
+         'دنا': ['پلاس', 'توربو', 'پلاس توربو 6 دنده'],
+         '207': ['پانا', 'پانامرا', 'تیپ'],
+         'دیگنیتی': ['پرایم'],
+         'جک': ['j4', 'j7'],
+         'فیدلیتی': ['پرستیژ', 'داخل طوسی 5 نفره'],
+         'سورن': ['پلاس'],
+         'تارا': ['اتومات v4 تیتانیوم'],
+         'تویوتا': ['لوین 1200'],
+     },
+     'message': "مدل با برند تطابق ندارد"},
+    {'name': 'mileage', 'kind': 'range', 'column': 'mileage', 'ranges': [[0, 500000]],
+     'message': "کارکرد خارج از محدوده (0-500K)"},
+]
+VALID_STATUS = "درست"
+
+validation_lock = threading.Lock()
+_validation_state = {'mtime': None, 'rules': None}
+
+# قواعد از فایل تنظیمات (اگه باشه) خونده می‌شن و فقط با تغییر فایل دوباره بارگذاری می‌شن
+def load_validation_rules(path=None):
+    path = path or VALIDATION_RULES_PATH
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    with validation_lock:
+        if _validation_state['rules'] is not None and _validation_state['mtime'] == mtime:
+            return _validation_state['rules']
+        rules = DEFAULT_VALIDATION_RULES
+        if mtime is not None:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    rules = json.load(f)
+                check_validation_rules(rules)
+            except (OSError, ValueError) as e:
+                print(f"خطا در خواندن قواعد اعتبارسنجی از {path}: {e}؛ قواعد پیش‌فرض استفاده می‌شن")
+                rules = DEFAULT_VALIDATION_RULES
+        _validation_state.update(mtime=mtime, rules=rules)
+        return rules
+
+def check_validation_rules(rules):
+    if not isinstance(rules, list):
+        raise ValueError("قواعد باید یک لیست باشن")
+    for rule in rules:
+        if rule.get('kind') == 'range':
+            if not rule.get('column') or not all(len(bounds) == 2 for bounds in rule.get('ranges', [])):
+                raise ValueError(f"قاعده‌ی بازه‌ی نامعتبر: {rule.get('name')}")
+        elif rule.get('kind') == 'whitelist':
+            if not rule.get('column') or not rule.get('key') or not isinstance(rule.get('allowed'), dict):
+                raise ValueError(f"قاعده‌ی لیست مجاز نامعتبر: {rule.get('name')}")
+        else:
+            raise ValueError(f"نوع قاعده‌ی ناشناخته: {rule.get('kind')}")
+        if not rule.get('name') or not rule.get('message'):
+            raise ValueError("هر قاعده name و message لازم داره")
+
+# مقدارهای یک ستون متنی به صورت کد + مقدارهای یکتا (حروف کوچک)؛ مقدار خالی کد -1 می‌گیره
+# بررسی‌های متنی فقط روی مقدارهای یکتا انجام می‌شه نه روی تک‌تک ردیف‌ها
+def text_codes(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series)
+    return codes, [str(value).lower() for value in uniques]
 
-    if 'mileage' in car and not pd.isna(car['mileage']):
-        mileage = car['mileage']
-        if not (0 <= mileage <= 500000):
-            status = "مشکوک: کارکرد خارج از محدوده (0-500K)"
+# ماسک آگهی‌هایی که یک قاعده رو نقض می‌کنن
+def rule_violations(df, rule):
+    n = len(df)
+    if rule['column'] not in df:
+        return np.zeros(n, dtype=bool)
+    if rule['kind'] == 'range':
+        values = pd.to_numeric(df[rule['column']], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        inside = np.zeros(n, dtype=bool)
+        for low, high in rule['ranges']:
+            inside |= (values >= low) & (values <= high)
+        return ~inside & ~np.isnan(values)
 
-    return status
+    if rule['key'] not in df:
+        return np.zeros(n, dtype=bool)
+    key_codes, keys = text_codes(df[rule['key']])
+    value_codes, values = text_codes(df[rule['column']])
+    # جدول (کلید × مقدار یکتا)؛ سطر و ستون آخر برای مقدار خالی (کد -1) که هیچ‌وقت نقض حساب نمی‌شه
+    table = np.zeros((len(keys) + 1, len(values) + 1), dtype=bool)
+    allowed = {key.lower(): [m.lower() for m in models] for key, models in rule['allowed'].items()}
+    for code, key in enumerate(keys):
+        if key in allowed:
+            table[code, :-1] = [not any(m in value for m in allowed[key]) for value in values]
+    return table[key_codes, value_codes]
+
+# اعتبارسنجی ستونی یک دسته آگهی
+# خروجی: جدول بولی (یک ستون برای هر قاعده) و وضعیت هر آگهی با همه‌ی قواعد نقض‌شده
+def validate_frame(df, rules=None):
+    rules = load_validation_rules() if rules is None else rules
+    masks = np.column_stack([rule_violations(df, rule) for rule in rules]) if rules else np.zeros((len(df), 0), bool)
+    # هر ترکیب از قواعد نقض‌شده یک عدد می‌شه و متن وضعیت فقط برای ترکیب‌های یکتا ساخته می‌شه
+    combos = masks.astype(np.int64) @ (np.int64(1) << np.arange(len(rules), dtype=np.int64))
+    inverse, uniques = pd.factorize(combos)
+    labels = []
+    for combo in uniques:
+        messages = [rule['message'] for i, rule in enumerate(rules) if combo >> i & 1]
+        labels.append("مشکوک: " + "؛ ".join(messages) if messages else VALID_STATUS)
+    status = pd.Series(np.array(labels, dtype=object)[inverse], index=df.index, dtype=object)
+    violations = pd.DataFrame(masks, index=df.index, columns=[rule['name'] for rule in rules])
+    return violations, status
+
+# مدل دسته‌بندی یک بار بارگذاری می‌شه و فقط وقتی فایل‌هاش عوض بشن دوباره خونده می‌شه
+classifier_lock = threading.Lock()
+_classifier_state = {'mtime': None, 'vectorizer': None, 'classifier': None}
+
+def load_classifier():
+    try:
+        mtime = max(os.path.getmtime(VECTORIZER_PATH), os.path.getmtime(CLASSIFIER_PATH))
+    except OSError:
+        mtime = None
+
+    with classifier_lock:
+        if _classifier_state['classifier'] is not None and _classifier_state['mtime'] == mtime:
+            return _classifier_state['vectorizer'], _classifier_state['classifier']
+
+        metrics.inc('car_filter_cache_requests_total', cache='classifier', result='miss')
+        if mtime is None:
+            print("فایل مدل دسته‌بندی پیدا نشد؛ مدل موقت در حافظه ساخته می‌شه (برای ذخیره: python main.py train)")
+            vectorizer, classifier = build_classifier()
+        else:
+            with open(VECTORIZER_PATH, 'rb') as f:
+                vectorizer = pickle.load(f)
+            with open(CLASSIFIER_PATH, 'rb') as f:
+                classifier = pickle.load(f)
+        _classifier_state.update(mtime=mtime, vectorizer=vectorizer, classifier=classifier)
+        return vectorizer, classifier
+
+# دسته‌بندی یک دسته پیام با یک بار transform و predict؛ برای هر پیام True/False برمی‌گردونه
+def filter_relevant(messages):
+    if not messages:
+        return []
+    vectorizer, classifier = load_classifier()
+    with timed('classify'):
+        relevant = (classifier.predict(vectorizer.transform(messages)) == "مرتبط").tolist()
+    accepted = sum(relevant)
+    metrics.inc('car_filter_classifier_decisions_total', accepted, result='accepted')
+    metrics.inc('car_filter_classifier_decisions_total', len(relevant) - accepted, result='rejected')
+    return relevant
 
 # تابع تشخیص کانال مرتبط
 def is_relevant_channel(message):
-    with open('vectorizer.pkl', 'rb') as f:
-        vectorizer = pickle.load(f)
-    with open('channel_classifier.pkl', 'rb') as f:
-        classifier = pickle.load(f)
-    message_vector = vectorizer.transform([message])
-    prediction = classifier.predict(message_vector)
-    return prediction[0] == "مرتبط"
+    return filter_relevant([message])[0]
+
+# شناسه‌ی کانال‌ها فقط یک بار از تلگرام گرفته می‌شه
+_entity_cache = {}
+
+# اجرای یک درخواست تلگرام؛ اگه FloodWait بگیریم به اندازه‌ی خواسته‌شده صبر و دوباره تلاش می‌کنیم
+async def call_with_flood_wait(make_call, channel):
+    from telethon.errors import FloodWaitError
+    for attempt in range(FLOOD_WAIT_RETRIES + 1):
+        try:
+            return await make_call()
+        except FloodWaitError as e:
+            if attempt == FLOOD_WAIT_RETRIES:
+                raise
+            print(f"محدودیت تلگرام برای {channel}: {e.seconds} ثانیه صبر می‌کنیم")
+            metrics.inc('car_filter_flood_waits_total', channel=channel)
+            await asyncio.sleep(e.seconds + 1)
+
+async def resolve_entity(client, channel):
+    if channel not in _entity_cache:
+        _entity_cache[channel] = await call_with_flood_wait(lambda: client.get_entity(channel), channel)
+    return _entity_cache[channel]
+
+# گرفتن تاریخچه‌ی یک کانال به صورت صفحه‌به‌صفحه (از جدید به قدیم) تا رسیدن به min_id یا تاریخ
+# FETCH_SINCE_DAYS. سقف FETCH_MAX_DEPTH فقط برای اولین دریافت کانال (بدون watermark) است؛ بعد از اون
+# همه‌ی پیام‌های بعد از watermark گرفته می‌شن، وگرنه بعد از قطعی یا حجم زیاد پیام، watermark به جدیدترین
+# پیام می‌پرید و پیام‌های بین watermark قبلی و قدیمی‌ترین پیام گرفته‌شده هیچ‌وقت گرفته نمی‌شدن
+async def fetch_channel_history(client, channel, min_id, semaphore):
+    async with semaphore:
+        entity = await resolve_entity(client, channel)
+        since = None
+        if FETCH_SINCE_DAYS:
+            since = datetime.now(timezone.utc) - timedelta(days=FETCH_SINCE_DAYS)
+
+        depth = FETCH_MAX_DEPTH if not min_id else float('inf')
+        collected = []
+        offset_id = 0
+        while len(collected) < depth:
+            page_size = int(min(FETCH_LIMIT, depth - len(collected)))
+            history = await call_with_flood_wait(lambda: client(GetHistoryRequest(
+                peer=entity,
+                limit=page_size,
+                offset_id=offset_id,
+                offset_date=None,
+                add_offset=0,
+                max_id=0,
+                min_id=min_id,
+                hash=0
+            )), channel)
+            page = history.messages
+            if since:
+                page = [msg for msg in page if msg.date >= since]
+            collected.extend(page)
+            if len(page) < page_size:
+                break
+            offset_id = page[-1].id
+        return collected
 
 # تابع گرفتن پیام‌ها از تلگرام
-async def fetch_messages():
+# watermarks: بزرگ‌ترین شناسه‌ی پیام دیده‌شده برای هر کانال؛ فقط پیام‌های جدیدتر گرفته می‌شن
+# و دیکشنری در همین تابع به‌روز می‌شه. کانال‌ها همزمان (حداکثر FETCH_CONCURRENCY تا) گرفته می‌شن.
+async def fetch_messages(watermarks=None):
+    if watermarks is None:
+        watermarks = {}
     async with TelegramClient('session', API_ID, API_HASH) as client:
         await client.start(phone=PHONE)
-        messages = []
-        for channel in channel_list:
-            try:
-                entity = await client.get_entity(channel)
-                history = await client(GetHistoryRequest(
-                    peer=entity,
-                    limit=100,
-                    offset_id=0,
-                    offset_date=None,
-                    add_offset=0,
-                    max_id=0,
-                    min_id=0,
-                    hash=0
-                ))
-                for msg in history.messages:
-                    if msg.message:
-                        # فقط پیام‌های مرتبط رو اضافه کن
-                        if is_relevant_channel(msg.message):
-                            messages.append(f"{channel}||{msg.message}")
-                print(f"تعداد پیام‌های گرفته‌شده از {channel}: {len(history.messages)}")
-            except Exception as e:
-                print(f"خطا در گرفتن پیام‌ها از {channel}: {e}")
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+        with timed('fetch'):
+            results = await asyncio.gather(
+                *(fetch_channel_history(client, channel, watermarks.get(channel, 0), semaphore) for channel in channel_list),
+                return_exceptions=True
+            )
+
+        candidates = []
+        for channel, history in zip(channel_list, results):
+            if isinstance(history, BaseException):
+                print(f"خطا در گرفتن پیام‌ها از {channel}: {history}")
+                metrics.inc('car_filter_fetch_errors_total', channel=channel)
                 continue
-        return messages
+            metrics.inc('car_filter_fetched_messages_total', len(history), channel=channel)
+            if history:
+                watermarks[channel] = max(watermarks.get(channel, 0), max(msg.id for msg in history))
+            for msg in history:
+                if getattr(msg, 'message', None):
+                    candidates.append((channel, msg.id, msg.date, msg.message))
+            print(f"تعداد پیام‌های گرفته‌شده از {channel}: {len(history)}")
+
+        # فقط پیام‌های مرتبط رو نگه دار (کل دسته با یک بار پیش‌بینی)
+        relevant = filter_relevant([msg[3] for msg in candidates])
+        return [msg for msg, keep in zip(candidates, relevant) if keep]
+
+# یکسان‌سازی متن قبل از استخراج: ارقام فارسی/عربی به انگلیسی و «ي»/«ك» عربی به «ی»/«ک» فارسی
+NORMALIZE_TABLE = str.maketrans({
+    **{digit: str(i) for i, digit in enumerate('۰۱۲۳۴۵۶۷۸۹')},
+    **{digit: str(i) for i, digit in enumerate('٠١٢٣٤٥٦٧٨٩')},
+    'ي': 'ی',
+    'ك': 'ک',
+})
+
+def normalize_text(text):
+    return text.translate(NORMALIZE_TABLE)
+
+# جدول قواعد استخراج؛ همه‌ی الگوها یک بار کامپایل می‌شن
+EXTRACTION_RULES = {
+    'brand': re.compile(r'(دیگنیتی|پراید|دنا|پژو|سمند|تویوتا|هیوندای|کیا|بنز|بی\s*ام\s*و|ام\s*وی\s*ام|جک|چری|رنو|فولکس|نیسان|مزدا|فورد|شورلت|سانتافه|207|پانا|فیدلیتی|سورن|ری\s*را|تارا)', re.IGNORECASE),
+    'extra_info': re.compile(r'(داخل\s*\w+\s*\d*\s*نفره?)'),
+    'color': re.compile(r'((رنگ\s+)?(?:مشکی|سفید|خاکستری|قرمز|آبی|سبز|طلایی|مارون|تیتانیوم|سقف مشکی))'),
+    'year': re.compile(r'(?:سال|مدل)\s*(140[0-4]|13[9-9][0-9]|20[0-2][0-9])'),
+    'year_fallback': re.compile(r'(140[0-4]|13[9-9][0-9]|20[0-2][0-9])(?=\s*برج|\s|$|[^\d])'),
+    'price': re.compile(r'(?:\bقیمت\s*)?(\d+[./]\d+[./]\d+|\d{3,})(?:\s*(?:تومان|میلیون|تومن|میلیارد))?'),
+    'mileage': re.compile(r'(\d{1,3}(?:,\d{3})*|\d+)\s*(?:کیلومتر|کارکرد|km)', re.IGNORECASE),
+    'body_condition': re.compile(r'بدنه\s*(سالم|رنگ\s*شده|تصادفی|تعویض|نیاز به تعمیر)', re.IGNORECASE),
+    'chassis_condition': re.compile(r'شاسی\s*(سالم|تعمیر\s*شده|تعویض|آسیب\s*دیده)', re.IGNORECASE),
+    'engine_condition': re.compile(r'موتور\s*(سالم|تعمیر\s*شده|تعویض|نیاز به تعمیر)', re.IGNORECASE),
+}
+CONDITION_FIELDS = ['body_condition', 'chassis_condition', 'engine_condition']
+MODEL_END = r'(?=\s*(?:داخل|رنگ|سفید|مشکی|طوسی|سال|مدل|قیمت|میلیون|تومن|کارکرد|بدنه|شاسی|موتور|$))'
+
+# hash جدول قواعد کامپایل‌شده، یکسان‌سازی متن و مدل spaCy؛ با هر تغییر الگوها کلید cache استخراج عوض می‌شه
+@functools.lru_cache(maxsize=1)
+def extractor_fingerprint():
+    rules = [(name, pattern.pattern, pattern.flags) for name, pattern in EXTRACTION_RULES.items()]
+    payload = json.dumps([EXTRACTOR_VERSION, rules, MODEL_END, sorted(NORMALIZE_TABLE.items()), SPACY_MODEL],
+                         ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+# الگوی مدل به برند بستگی داره؛ برای هر برند یک بار ساخته می‌شه (متن برند escape می‌شه).
+# بدون برند، جستجو فقط از ابتدای هر تکه‌ی متنی شروع می‌شه: اگه از ابتدای یک تکه پیدا نشه از
+# وسطش هم پیدا نمی‌شه، پس نتیجه همونه ولی دیگه برای هر حرف از نو امتحان نمی‌شه
+@functools.lru_cache(maxsize=512)
+def model_pattern(brand):
+    prefix = re.escape(brand) if brand else r'(?<![\w\s\d\-])'
+    return re.compile(r'(?:' + prefix + r'\s*)([\w\s\d\-]+?)' + MODEL_END)
+
+# سالی که بلافاصله بعد از «قیمت» یا «تومان» اومده در واقع بخشی از قیمته
+@functools.lru_cache(maxsize=512)
+def price_year_pattern(year):
+    return re.compile(r'(?:قیمت|تومان)\s*' + re.escape(year))
+
+def scale_price(price):
+    if price < 10:
+        price *= 1000
+    elif 10 <= price <= 100:
+        price *= 1000
+    elif price > 1000000:
+        price /= 1000000
+    return float(price)
+
+# برند از موجودیت‌های spaCy (آخرین PRODUCT یا ORG)
+def spacy_brand(doc):
+    brand = None
+    for ent in doc.ents:
+        if ent.label_ in ("PRODUCT", "ORG"):  # spaCy ممکنه برند رو به‌عنوان PRODUCT تشخیص بده
+            brand = ent.text
+    return brand
+
+# استخراج فیلدهای آگهی به صورت ستونی روی یک دسته متن یکسان‌شده (Series.str.extract به جای حلقه روی پیام‌ها)
+# brands: برندهای پیداشده با spaCy برای هر متن (یا None)
+def extract_fields_frame(texts, brands=None):
+    rules = EXTRACTION_RULES
+    texts = pd.Series(list(texts), dtype=object)
+    df = pd.DataFrame(index=texts.index)
+
+    # برند
+    spacy_brands = pd.Series(list(brands) if brands is not None else [None] * len(texts), index=texts.index, dtype=object)
+    regex_brands = texts.str.extract(rules['brand'], expand=False).str.replace(' ', '', regex=False)
+    has_spacy_brand = spacy_brands.fillna('').astype(bool)
+    df['brand'] = spacy_brands.where(has_spacy_brand, regex_brands)
+    df['brand'] = df['brand'].astype(object).where(df['brand'].notna(), None)
+
+    # مدل؛ الگو برای هر برند جدا اجرا می‌شه
+    model = pd.Series(None, index=texts.index, dtype=object)
+    for brand, idx in df.groupby(df['brand'].fillna(''), sort=False).groups.items():
+        found = texts[idx].str.extract(model_pattern(brand), expand=False).str.strip()
+        if brand:
+            found = found.str.replace(brand, '', regex=False).str.strip()
+        model[idx] = found
+    matched = model.notna()
+    extra_info = texts.str.extract(rules['extra_info'], expand=False).str.strip()
+    with_extra = matched & extra_info.notna()
+    model[with_extra] = (model[with_extra] + ' ' + extra_info[with_extra]).where(model[with_extra] != '', extra_info[with_extra])
+    is_pana = matched & (df['brand'] == '207') & model.str.lower().str.contains('پانا', regex=False, na=False).astype(bool)
+    model[is_pana] = 'پانامرا'
+    df['model'] = model.where(matched, None)
+
+    # رنگ
+    color = texts.str.extract(rules['color'], expand=False)[0]
+    df['color'] = color.str.replace('رنگ ', '', regex=False).str.strip().fillna("بدون اطلاعات")
+
+    # سال
+    year = texts.str.extract(rules['year'], expand=False)
+    fallback = texts.str.extract(rules['year_fallback'], expand=False).where(year.isna())
+    for value in fallback.dropna().unique():
+        rows = fallback.index[fallback == value]
+        in_price = texts[rows].str.contains(price_year_pattern(value))
+        fallback[rows[in_price.to_numpy()]] = None
+    df['year'] = year.fillna(fallback).astype(float)
+
+    # قیمت
+    price = texts.str.extract(rules['price'], expand=False)
+    price = price.str.replace(r'[/.,]', '', regex=True).map(float, na_action='ignore')
+    df['price'] = np.select(
+        [price < 10, price <= 100, price > 1000000],
+        [price * 1000, price * 1000, price / 1000000],
+        default=price
+    )
+
+    # کارکرد
+    mileage = texts.str.extract(rules['mileage'], expand=False)
+    df['mileage'] = mileage.str.replace(',', '', regex=False).map(int, na_action='ignore').astype(float)
+
+    # وضعیت بدنه، شاسی و موتور
+    for field in CONDITION_FIELDS:
+        df[field] = texts.str.extract(rules[field], expand=False).fillna("بدون اطلاعات")
+
+    return df
+
+# فقط پیام‌هایی که برند یا مدل و سال یا قیمت دارن آگهی حساب می‌شن
+def is_listing(car):
+    return bool((car.get('brand') or car.get('model')) and (car.get('year') or car.get('price') is not None))
+
+# تبدیل یک ردیف خروجی extract_fields_frame به دیکشنری با انواع پایتونی
+def frame_row_to_car(row):
+    car = {}
+    for field, value in row.items():
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            value = None
+        elif field in ('year', 'mileage'):
+            value = int(value)
+        elif field == 'price':
+            value = float(value)
+        if value is not None or field in ('brand', 'model'):
+            car[field] = value
+    return car
+
+# ثبت تعداد دفعاتی که هر فیلد در متن پیدا شده (برای نرخ موفقیت استخراج هر فیلد)
+def record_field_hits(fields):
+    metrics.inc('car_filter_extracted_messages_total', len(fields))
+    for field in fields.columns:
+        found = fields[field].notna() & (fields[field] != "بدون اطلاعات")
+        metrics.inc('car_filter_extracted_fields_total', int(found.sum()), field=field)
+
+# استخراج دسته‌ای: متن‌هایی که قبلاً دیده شدن از cache خونده می‌شن و بقیه با nlp.pipe
+# و استخراج ستونی پردازش می‌شن. برای هر متن دیکشنری فیلدها یا None (اگه آگهی نباشه) برمی‌گردونه
+def extract_cars(texts):
+    normalized = [normalize_text(text) for text in texts]
+    keys = [extraction_key(text) for text in normalized]
+    cached = load_extraction_cache(set(keys)) if EXTRACTION_CACHE else {}
+    missing = list({key: i for i, key in reversed(list(enumerate(keys))) if key not in cached}.values())
+    metrics.inc('car_filter_cache_requests_total', len(keys) - len(missing), cache='extraction', result='hit')
+    metrics.inc('car_filter_cache_requests_total', len(missing), cache='extraction', result='miss')
+
+    if missing:
+        missing_texts = [normalized[i] for i in missing]
+        nlp, disabled = get_nlp()
+        with timed('spacy'):
+            brands = [spacy_brand(doc) for doc in nlp.pipe(missing_texts, batch_size=SPACY_BATCH_SIZE,
+                                                            n_process=SPACY_N_PROCESS, disable=disabled)]
+        with timed('regex_extraction'):
+            fields = extract_fields_frame(missing_texts, brands)
+        record_field_hits(fields)
+        new_entries = {}
+        for i, (_, row) in zip(missing, fields.iterrows()):
+            car = frame_row_to_car(row)
+            if is_listing(car):
+                new_entries[keys[i]] = {field: car.get(field) for field in CAR_FIELDS}
+            else:
+                new_entries[keys[i]] = None
+        if EXTRACTION_CACHE:
+            save_extraction_cache(new_entries)
+        cached.update(new_entries)
+
+    # وضعیت در cache نگه داشته نمی‌شه؛ با قواعد فعلی برای کل دسته یک‌جا حساب می‌شه
+    results = [dict(cached[key]) if cached[key] else None for key in keys]
+    listings = [car for car in results if car]
+    if listings:
+        with timed('validation'):
+            _, status = validate_frame(pd.DataFrame(listings, columns=CAR_FIELDS))
+        for car, value in zip(listings, status):
+            car['status'] = value
+    return results
 
 # تابع پردازش داده‌ها با spaCy
 def process_messages(messages):
     print(f"تعداد کل پیام‌های دریافتی: {len(messages)}")
+    records = [msg.split('||', 1) for msg in messages if '||' in msg]
+    with timed('process_messages'):
+        results = extract_cars([text for _, text in records])
     cars = []
-    for msg in messages:
-        try:
-            if '||' not in msg:
-                continue
-            channel, text = msg.split('||', 1)
-            car = {'channel': channel.strip(), 'raw_text': text.strip()}
+    for (channel, text), fields in zip(records, results):
+        if fields:
+            cars.append({'channel': channel.strip(), 'raw_text': text.strip(), **fields})
+
+    print(f"تعداد آگهی‌های پردازش‌شده: {len(cars)}")
+    df = pd.DataFrame(cars)
+    if 'price' not in df.columns:
+        df['price'] = None
+    return df, None
+
+# مدل خوشه‌بندی: یک بار ساخته و در فایل ذخیره می‌شه و با رسیدن آگهی‌های جدید با partial_fit
+# به‌روز می‌شه؛ برچسب هر خوشه از مرکزش تعیین می‌شه تا بین دو بار بارگذاری صفحه ثابت بمونه
+CLUSTER_MODEL_PATH = 'cluster_model.pkl'
+N_CLUSTERS = 3
+NO_CLUSTER = 'بدون گروه'
+
+def cluster_label(year_mean, price_mean):
+    if year_mean >= 1402 and price_mean > 1500:
+        return "ماشین‌های جدید و گران"
+    elif year_mean <= 1398:
+        return "ماشین‌های قدیمی و ارزان"
+    return "ماشین‌های متوسط"
+
+def name_clusters(model):
+    centers = model['scaler'].inverse_transform(model['kmeans'].cluster_centers_)
+    model['labels'] = np.array([cluster_label(int(year), int(price)) for year, price in centers], dtype=object)
+    return model
+
+# ردیف‌هایی که سال و قیمت دارن و ماتریس ویژگی‌هاشون
+def cluster_features(df):
+    if 'year' not in df.columns or 'price' not in df.columns:
+        return df.index[:0], np.empty((0, 2))
+    valid = df[['year', 'price']].apply(pd.to_numeric, errors='coerce').dropna()
+    return valid.index, valid.to_numpy(dtype=float)
+
+def build_cluster_model(X):
+    scaler = StandardScaler().fit(X)
+    kmeans = MiniBatchKMeans(n_clusters=N_CLUSTERS, random_state=0, n_init=3).fit(scaler.transform(X))
+    return name_clusters({'scaler': scaler, 'kmeans': kmeans})
+
+cluster_lock = threading.Lock()
+_cluster_state = {'mtime': None, 'model': None}
 
-            # استفاده از spaCy برای استخراج اطلاعات
-            doc = nlp(text)
+def cluster_model_mtime():
+    try:
+        return os.path.getmtime(CLUSTER_MODEL_PATH)
+    except OSError:
+        return None
 
-            # برند و مدل (بهبود با spaCy)
-            brand = None
+# مدل ذخیره‌شده (یا None اگه هنوز ساخته نشده)؛ فقط وقتی فایل عوض بشه دوباره خونده می‌شه
+def load_cluster_model():
+    mtime = cluster_model_mtime()
+    with cluster_lock:
+        if _cluster_state['mtime'] != mtime:
             model = None
-            for ent in doc.ents:
-                if ent.label_ == "PRODUCT":  # spaCy ممکنه برند رو به‌عنوان PRODUCT تشخیص بده
-                    brand = ent.text
-                elif ent.label_ == "ORG":
-                    brand = ent.text
-            # اگر spaCy برند رو پیدا نکرد، از regex قبلی استفاده کن
-            if not brand:
-                brand_match = re.search(r'(دیگنیتی|پراید|دنا|پژو|سمند|تویوتا|هیوندای|کیا|بنز|بی\s*ام\s*و|ام\s*وی\s*ام|جک|چری|رنو|فولکس|نیسان|مزدا|فورد|شورلت|سانتافه|207|پانا|فیدلیتی|سورن|ری\s*را|تارا)', text, re.IGNORECASE)
-                if brand_match:
-                    brand = brand_match.group(1).replace(' ', '')
-            car['brand'] = brand
-
-            # مدل
-            model_match = re.search(r'(?:' + (car.get('brand', '') or '') + r'\s*)([\w\s\d\-]+?)(?=\s*(?:داخل|رنگ|سفید|مشکی|طوسی|سال|مدل|قیمت|میلیون|تومن|کارکرد|بدنه|شاسی|موتور|$))', text, re.UNICODE)
-            if model_match:
-                model = model_match.group(1).strip()
-                if car.get('brand'):
-                    model = model.replace(car['brand'], '').strip()
-                extra_info = re.search(r'(داخل\s*\w+\s*\d*\s*نفره?)', text, re.UNICODE)
-                if extra_info:
-                    model = f"{model} {extra_info.group(1).strip()}" if model else extra_info.group(1).strip()
-                if car.get('brand') == '207' and 'پانا' in model.lower():
-                    model = 'پانامرا'
-            car['model'] = model
-
-            # رنگ
-            color_match = re.search(r'(رنگ\s+)?(?:مشکی|سفید|خاکستری|قرمز|آبی|سبز|طلایی|مارون|تیتانیوم|سقف مشکی)', text)
-            if color_match:
-                car['color'] = color_match.group(0).replace('رنگ ', '').strip()
-            else:
-                car['color'] = "بدون اطلاعات"
+            if mtime is not None:
+                with open(CLUSTER_MODEL_PATH, 'rb') as f:
+                    model = pickle.load(f)
+            _cluster_state.update(mtime=mtime, model=model)
+        return _cluster_state['model']
 
-            # سال
-            year_match = re.search(r'(?:سال|مدل)\s*(140[0-4]|13[9-9][0-9]|20[0-2][0-9])', text)
-            if year_match:
-                year = year_match.group(1)
-                car['year'] = int(year)
-            else:
-                year_match = re.search(r'(140[0-4]|13[9-9][0-9]|20[0-2][0-9])(?=\s*برج|\s|$|[^\d])', text)
-                if year_match and not re.search(r'(?:قیمت|تومان)\s*' + year_match.group(1), text):
-                    car['year'] = int(year_match.group(1))
-
-            # قیمت
-            price_match = re.search(r'(?:\bقیمت\s*)?(\d+[./]\d+[./]\d+|\d{3,})(?:\s*(?:تومان|میلیون|تومن|میلیارد))?', text)
-            if price_match:
-                price = price_match.group(1).replace('/', '').replace('.', '').replace(',', '')
-                try:
-                    price = float(price)
-                    if price < 10:
-                        price *= 1000
-                    elif 10 <= price <= 100:
-                        price *= 1000
-                    elif 100 < price <= 1000:
-                        price = price
-                    elif price > 1000000:
-                        price /= 1000000
-                    car['price'] = float(price)
-                except ValueError:
-                    car['price'] = None
-
-            # کارکرد
-            mileage_match = re.search(r'(\d{1,3}(?:,\d{3})*|\d+)\s*(?:کیلومتر|کارکرد|km)', text, re.IGNORECASE)
-            if mileage_match:
-                mileage = mileage_match.group(1).replace(',', '')
-                car['mileage'] = int(mileage)
-
-            # وضعیت بدنه
-            body_match = re.search(r'بدنه\s*(سالم|رنگ\s*شده|تصادفی|تعویض|نیاز به تعمیر)', text, re.IGNORECASE)
-            if body_match:
-                car['body_condition'] = body_match.group(1)
-            else:
-                car['body_condition'] = "بدون اطلاعات"
+def save_cluster_model(model):
+    tmp_path = f"{CLUSTER_MODEL_PATH}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(model, f)
+    os.replace(tmp_path, CLUSTER_MODEL_PATH)
+
+# به‌روزرسانی مدل با آگهی‌های جدید (در پس‌زمینه)؛ اگه هنوز مدلی نباشه روی همین آگهی‌ها ساخته می‌شه
+def update_cluster_model(listings):
+    _, X = cluster_features(listings)
+    model = load_cluster_model()
+    if model is None:
+        if len(X) < N_CLUSTERS:
+            return None
+        with timed('cluster_fit'):
+            model = build_cluster_model(X)
+    else:
+        if not len(X):
+            return model
+        with timed('cluster_fit'):
+            model['kmeans'].partial_fit(model['scaler'].transform(X))
+        name_clusters(model)
+    save_cluster_model(model)
+    return model
+
+# تابع خوشه‌بندی؛ برچسب‌ها با predict مدل ذخیره‌شده داده می‌شن. اگه مدلی نباشه و fit_missing
+# فعال باشه یک مدل موقت روی همین داده‌ها ساخته می‌شه، وگرنه همه «بدون گروه» می‌شن
+def cluster_cars(df, fit_missing=True):
+    index, X = cluster_features(df)
+    model = load_cluster_model()
+    if model is None and fit_missing and len(X) >= N_CLUSTERS:
+        model = build_cluster_model(X)
+
+    df['cluster'] = NO_CLUSTER
+    if model is not None and len(X):
+        with timed('cluster'):
+            df.loc[index, 'cluster'] = model['labels'][model['kmeans'].predict(model['scaler'].transform(X))]
+    return df
+
+# فیلدهایی که از هر آگهی استخراج و در پایگاه‌داده ذخیره می‌شن
+CAR_FIELDS = ['brand', 'model', 'color', 'year', 'price', 'mileage',
+              'body_condition', 'chassis_condition', 'engine_condition', 'status']
+
+# ستون‌های جدول آگهی‌های حافظه (برای وقتی که هنوز داده‌ای نرسیده)
+# متن کامل آگهی در این جدول نیست و فقط موقع نیاز از پایگاه‌داده خونده می‌شه (load_raw_texts)
+LISTING_COLUMNS = ['channel', 'msg_id', 'posted_at'] + CAR_FIELDS + ['cluster', 'repost_count', 'channels', 'deal_score']
+
+# نوع ستون‌ها در جدول حافظه: متن‌های کم‌تنوع categorical، تاریخ datetime64 و عددها با کوچک‌ترین
+# نوعی که جا بشن؛ برای حدود یک سال آگهی همه‌ی کانال‌ها چند برابر کمتر از ستون‌های object حافظه می‌گیره
+LISTING_DTYPES = {
+    'channel': 'category',
+    'msg_id': 'int32',
+    'posted_at': 'datetime',
+    'brand': 'category',
+    'model': 'category',
+    'color': 'category',
+    'year': 'Int16',
+    'price': 'float32',
+    'mileage': 'Int32',
+    'body_condition': 'category',
+    'chassis_condition': 'category',
+    'engine_condition': 'category',
+    'status': 'category',
+    'cluster': 'category',
+    'repost_count': 'int32',
+    'channels': 'category',
+    'deal_score': 'float32',
+}
+
+# ساختار پایگاه‌داده: هر پیام مرتبط با (کانال، شناسه‌ی پیام) یکتا می‌شه و hash متنش نگه داشته می‌شه
+# تا پیام‌های ویرایش‌شده دوباره پردازش بشن
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    channel TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    posted_at TEXT,
+    content_hash TEXT NOT NULL,
+    raw_text TEXT,
+    is_listing INTEGER NOT NULL DEFAULT 0,
+    brand TEXT,
+    model TEXT,
+    color TEXT,
+    year INTEGER,
+    price REAL,
+    mileage INTEGER,
+    body_condition TEXT,
+    chassis_condition TEXT,
+    engine_condition TEXT,
+    status TEXT,
+    PRIMARY KEY (channel, msg_id)
+);
+CREATE INDEX IF NOT EXISTS idx_listings_brand ON listings (brand);
+CREATE INDEX IF NOT EXISTS idx_listings_year ON listings (year);
+CREATE INDEX IF NOT EXISTS idx_listings_price ON listings (price);
+CREATE TABLE IF NOT EXISTS watermarks (
+    channel TEXT PRIMARY KEY,
+    max_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS extraction_cache (
+    text_hash TEXT PRIMARY KEY,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    channel TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    signature BLOB NOT NULL,
+    group_id INTEGER NOT NULL,
+    PRIMARY KEY (channel, msg_id)
+);
+CREATE INDEX IF NOT EXISTS idx_fingerprints_group ON fingerprints (group_id);
+CREATE TABLE IF NOT EXISTS lsh_buckets (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    PRIMARY KEY (band, bucket, channel, msg_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_lsh_buckets_message ON lsh_buckets (channel, msg_id);
+CREATE TABLE IF NOT EXISTS price_stats (
+    brand TEXT NOT NULL,
+    model TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    sketch TEXT NOT NULL,
+    PRIMARY KEY (brand, model, year)
+);
+CREATE TABLE IF NOT EXISTS price_trends (
+    brand TEXT NOT NULL,
+    model TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    week TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (brand, model, year, week)
+);
+CREATE TABLE IF NOT EXISTS price_observations (
+    channel TEXT NOT NULL,
+    msg_id INTEGER NOT NULL,
+    brand TEXT NOT NULL,
+    model TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    week TEXT NOT NULL,
+    price REAL NOT NULL,
+    group_id INTEGER,
+    PRIMARY KEY (channel, msg_id)
+);
+CREATE INDEX IF NOT EXISTS idx_price_observations_group ON price_observations (group_id);
+'''
+
+# هر thread اتصال خودش رو به پایگاه‌داده داره
+_db_local = threading.local()
+
+# ستون‌هایی که بعداً به جدول‌ها اضافه شدن؛ پایگاه‌داده‌های قدیمی‌تر ALTER می‌شن
+# version: نسخه‌ی داده‌ای که ردیف در اون اضافه یا عوض شده (برای فرستادن تغییرات به /events)
+DB_MIGRATIONS = [
+    ('listings', 'version', 'INTEGER', "CREATE INDEX IF NOT EXISTS idx_listings_version ON listings (version)"),
+    ('lsh_buckets', 'seq', 'INTEGER', "CREATE INDEX IF NOT EXISTS idx_lsh_buckets_recent ON lsh_buckets (band, bucket, seq)"),
+]
+
+def migrate_db(conn):
+    for table, column, kind, index in DB_MIGRATIONS:
+        if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+        conn.execute(index)
+    conn.commit()
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(DB_SCHEMA)
+        migrate_db(conn)
+        _db_local.conn = conn
+    return conn
+
+def content_hash(text):
+    return hashlib.sha1(text.strip().encode('utf-8')).hexdigest()
+
+# cache استخراج با کلید hash متن؛ آگهی‌هایی که عیناً دوباره ارسال می‌شن دوباره پردازش نمی‌شن
+def extraction_key(text):
+    return hashlib.sha1(f"{extractor_fingerprint()}|{text}".encode('utf-8')).hexdigest()
+
+def load_extraction_cache(keys):
+    conn = get_db()
+    keys = list(keys)
+    cached = {}
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        rows = conn.execute(
+            "SELECT text_hash, result FROM extraction_cache WHERE text_hash IN (" + ", ".join("?" * len(chunk)) + ")",
+            chunk
+        ).fetchall()
+        cached.update((key, json.loads(result)) for key, result in rows)
+    return cached
+
+def save_extraction_cache(entries):
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO extraction_cache (text_hash, result) VALUES (?, ?)",
+            [(key, json.dumps(result, ensure_ascii=False)) for key, result in entries.items()]
+        )
+
+# نسخه‌ی داده‌ها؛ با هر تغییر در آگهی‌ها یکی زیاد می‌شه
+def get_data_version(conn=None):
+    conn = conn or get_db()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()
+    return int(row[0]) if row else 0
+
+# زمان آخرین تغییر داده‌ها (برای هدر Last-Modified)
+def get_data_updated_at(conn=None):
+    conn = conn or get_db()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'updated_at'").fetchone()
+    return datetime.fromisoformat(row[0]) if row else None
+
+def load_watermarks():
+    return dict(get_db().execute("SELECT channel, max_id FROM watermarks").fetchall())
+
+# تشخیص آگهی‌های تکراری (بازنشر یک ماشین در کانال‌ها و روزهای مختلف با تغییرات کوچک مثل ایموجی،
+# شماره تلفن یا شکست خط) با MinHash و LSH: هر آگهی فقط با آگهی‌هایی مقایسه می‌شه که حداقل در یک
+# باند امضای یکسان دارن، پس هزینه‌ی هر آگهی ثابته و کل کار تقریباً خطیه (بدون مقایسه‌ی دوبه‌دو)
+DEDUP_SHINGLE = 5
+MINHASH_SIZE = 64
+LSH_BANDS = 16
+DEDUP_THRESHOLD = 0.7
+DEDUP_MAX_CANDIDATES = 50
+# از هر باند فقط این تعداد از جدیدترین آگهی‌ها خونده می‌شه؛ آگهی‌های یک نمایشگاه که متن ثابت مشترک دارن
+# همه در چند باند یکسان می‌افتن و بدون این سقف هر آگهی جدید همه‌ی قبلی‌ها رو می‌شمره
+DEDUP_BUCKET_LIMIT = 100
+MINHASH_PRIME = (1 << 31) - 1
+# شماره تلفن، لینک، آیدی کانال و علامت‌ها در مقایسه‌ی متن حساب نمی‌شن
+DEDUP_NOISE = re.compile(r'(?:\+98|0)9\d{9}|https?://\S+|@\w+|[^\w\s]|_')
+
+@functools.lru_cache(maxsize=1)
+def minhash_params():
+    rng = np.random.default_rng(0)
+    return (rng.integers(1, MINHASH_PRIME, MINHASH_SIZE, dtype=np.uint64),
+            rng.integers(0, MINHASH_PRIME, MINHASH_SIZE, dtype=np.uint64))
+
+def dedup_text(text):
+    return ' '.join(DEDUP_NOISE.sub(' ', normalize_text(text).lower()).split())
+
+def minhash_signature(text):
+    text = dedup_text(text)
+    shingles = {text[i:i + DEDUP_SHINGLE] for i in range(max(len(text) - DEDUP_SHINGLE + 1, 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                         dtype=np.uint64, count=len(shingles))
+    a, b = minhash_params()
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+# کلید هر باند امضا (برای SQLite در ۷ بایت جا می‌شه)
+def lsh_buckets(signature):
+    rows = MINHASH_SIZE // LSH_BANDS
+    return [(band, int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(),
+                                                  digest_size=7).digest(), 'big'))
+            for band in range(LSH_BANDS)]
+
+# برند، رنگ، سال و قیمت استخراج‌شده (اگه در هر دو آگهی باشن) باید یکی باشن و مدل یکی داخل دیگری باشه
+DEDUP_FIELDS = ['brand', 'model', 'color', 'year', 'price']
+
+def same_car(car, other):
+    for field in ('brand', 'color', 'year', 'price'):
+        if car.get(field) is not None and other.get(field) is not None and car[field] != other[field]:
+            return False
+    model, other_model = car.get('model'), other.get('model')
+    return not model or not other_model or model in other_model or other_model in model
+
+# کاندیداهای تکراری یک آگهی، از دو منبع که هر دو کار ثابتی دارن:
+# - آگهی‌هایی که حداقل یک باند مشترک دارن؛ از هر باند حداکثر DEDUP_BUCKET_LIMIT آگهی آخر (با ایندکس
+#   (band, bucket, seq)) خونده می‌شه تا باندهای پرجمعیت (متن ثابت آگهی‌های یک نمایشگاه) هر آگهی جدید رو
+#   با همه‌ی قبلی‌ها مقایسه نکنن. بین همین‌ها به ترتیب تعداد باندهای مشترک DEDUP_MAX_CANDIDATES تا انتخاب می‌شن
+# - آخرین آگهی‌های هم‌قیمت (ایندکس قیمت)، چون بازنشر یک آگهی قدیمی‌تر از یک نمایشگاه پرکار ممکنه از
+#   باندهای مشترک بیرون افتاده باشه و فقط قیمتش اون رو از بقیه‌ی آگهی‌های همون قالب جدا می‌کنه
+def find_duplicate_candidates(conn, buckets, price=None):
+    columns = "SELECT f.signature, f.group_id, " + ", ".join('l.' + field for field in DEDUP_FIELDS)
+    candidates = conn.execute(
+        columns + " FROM (SELECT channel, msg_id, COUNT(*) AS shared, MAX(seq) AS seq FROM ("
+        + " UNION ALL ".join(["SELECT * FROM (SELECT channel, msg_id, seq FROM lsh_buckets"
+                              " WHERE band = ? AND bucket = ? ORDER BY seq DESC LIMIT ?)"] * len(buckets))
+        + ") GROUP BY channel, msg_id ORDER BY shared DESC, seq DESC LIMIT ?) c"
+        + " JOIN fingerprints f ON f.channel = c.channel AND f.msg_id = c.msg_id"
+        + " JOIN listings l ON l.channel = f.channel AND l.msg_id = f.msg_id"
+        + " ORDER BY c.shared DESC, c.seq DESC",
+        [value for bucket in buckets for value in bucket + (DEDUP_BUCKET_LIMIT,)] + [DEDUP_MAX_CANDIDATES]
+    ).fetchall()
+    if price is not None:
+        candidates += conn.execute(
+            columns + " FROM (SELECT channel, msg_id FROM listings WHERE price = ? ORDER BY rowid DESC LIMIT ?) c"
+            + " JOIN fingerprints f ON f.channel = c.channel AND f.msg_id = c.msg_id"
+            + " JOIN listings l ON l.channel = f.channel AND l.msg_id = f.msg_id",
+            (price, DEDUP_MAX_CANDIDATES)
+        ).fetchall()
+    return candidates
+
+# گروه تکراری هر آگهی؛ entries: لیستی از (کانال، شناسه‌ی پیام، متن، فیلدهای آگهی یا None)
+# باید داخل تراکنشی اجرا بشه که خود آگهی‌ها رو ذخیره می‌کنه. خروجی: آگهی‌هایی که به یک گروه قبلی اضافه شدن
+def assign_duplicate_groups(conn, entries):
+    duplicates = set()
+    next_group = conn.execute("SELECT COALESCE(MAX(group_id), 0) + 1 FROM fingerprints").fetchone()[0]
+    for channel, msg_id, text, car in entries:
+        # پیام ویرایش‌شده امضای قبلیش رو از دست می‌ده
+        conn.execute("DELETE FROM fingerprints WHERE channel = ? AND msg_id = ?", (channel, msg_id))
+        conn.execute("DELETE FROM lsh_buckets WHERE channel = ? AND msg_id = ?", (channel, msg_id))
+        if not car:
+            continue
+
+        signature = minhash_signature(text)
+        buckets = lsh_buckets(signature)
+        group = None
+        candidates = find_duplicate_candidates(conn, buckets, car.get('price'))
+        if candidates:
+            # شباهت همه‌ی کاندیداها یک‌جا؛ شبیه‌ترین کاندیدایی که فیلدهاش هم بخونه انتخاب می‌شه
+            signatures = np.frombuffer(b''.join(row[0] for row in candidates), dtype=np.uint32)
+            similarity = (signatures.reshape(len(candidates), MINHASH_SIZE) == signature).mean(axis=1)
+            for index in np.argsort(-similarity, kind='stable'):
+                if similarity[index] < DEDUP_THRESHOLD:
+                    break
+                if same_car(car, dict(zip(DEDUP_FIELDS, candidates[index][2:]))):
+                    group = candidates[index][1]
+                    break
+        if group is None:
+            group, next_group = next_group, next_group + 1
+        else:
+            duplicates.add((channel, msg_id))
+
+        # rowid امضا ترتیب اضافه شدن رو نگه می‌داره (seq)
+        seq = conn.execute("INSERT INTO fingerprints (channel, msg_id, signature, group_id) VALUES (?, ?, ?, ?)",
+                           (channel, msg_id, signature.tobytes(), group)).lastrowid
+        conn.executemany("INSERT OR IGNORE INTO lsh_buckets (band, bucket, channel, msg_id, seq) VALUES (?, ?, ?, ?, ?)",
+                         [(band, bucket, channel, msg_id, seq) for band, bucket in buckets])
+    metrics.inc('car_filter_duplicates_total', len(duplicates))
+    return duplicates
+
+# ساختن دوباره‌ی گروه‌های تکراری برای همه‌ی آگهی‌های ذخیره‌شده (مثلاً بعد از تغییر آستانه)
+# python main.py dedup
+def rebuild_duplicate_groups(chunk_size=5000):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM fingerprints")
+        conn.execute("DELETE FROM lsh_buckets")
+    rows = conn.execute(
+        "SELECT channel, msg_id, raw_text, " + ", ".join(CAR_FIELDS)
+        + " FROM listings WHERE is_listing = 1 ORDER BY posted_at, channel, msg_id"
+    ).fetchall()
+    duplicates = 0
+    for start in range(0, len(rows), chunk_size):
+        with conn:
+            duplicates += len(assign_duplicate_groups(conn, [
+                (channel, msg_id, text, dict(zip(CAR_FIELDS, fields)))
+                for channel, msg_id, text, *fields in rows[start:start + chunk_size]
+            ]))
+    with conn:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('data_version', '1') "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+    print(f"تعداد آگهی‌ها: {len(rows)}، تکراری: {duplicates}")
+    # آمار قیمت هر گروه تکراری رو یک بار می‌شمره، پس با گروه‌های جدید دوباره ساخته می‌شه
+    rebuild_price_stats()
+    return duplicates
+
+# آمار قیمت هر (برند، مدل، سال): تعداد، میانگین و صدک‌ها با یک sketch لگاریتمی (شبیه DDSketch)
+# که با دقت نسبی PRICE_SKETCH_ACCURACY صدک‌ها رو می‌ده و قابل جمع و کم کردنه، به‌علاوه‌ی میانگین
+# هفتگی برای روند قیمت. این جدول‌ها موقع ذخیره‌ی آگهی‌ها به‌روز می‌شن و نه موقع درخواست.
+# price_observations آگهی‌هایی که در آمار حساب شدن رو نگه می‌داره تا ویرایش‌ها دوبار شمرده نشن
+PRICE_SKETCH_ACCURACY = 0.01
+PRICE_GAMMA = (1 + PRICE_SKETCH_ACCURACY) / (1 - PRICE_SKETCH_ACCURACY)
+PRICE_QUANTILES = {'p10': 0.1, 'p25': 0.25, 'median': 0.5, 'p75': 0.75, 'p90': 0.9}
+PRICE_TREND_WEEKS = 12
+PRICE_MIN_COUNT = 5  # امتیاز خرید فقط برای گروه‌هایی با حداقل این تعداد آگهی
+PRICE_STATS_VERSION = 2  # با تغییر نحوه‌ی محاسبه‌ی آمار، آمار از روی آگهی‌های ذخیره‌شده دوباره ساخته می‌شه
+
+# کلید گروه قیمت؛ مدل با حروف کوچک و سال نامعلوم 0
+def price_key(brand, model, year):
+    return (brand, (model or '').strip().lower(), int(year) if year else 0)
+
+def price_week(posted_at):
+    try:
+        date = datetime.fromisoformat(posted_at) if posted_at else datetime.now(timezone.utc)
+    except (TypeError, ValueError):
+        date = datetime.now(timezone.utc)
+    iso = date.isocalendar()
+    return f"{iso[0]}-W{iso[1]:02d}"
+
+def sketch_quantile(sketch, count, q):
+    rank = q * (count - 1)
+    cumulative = 0
+    for index in sorted(sketch, key=int):
+        cumulative += sketch[index]
+        if cumulative > rank:
+            return 2 * PRICE_GAMMA ** int(index) / (PRICE_GAMMA + 1)
+    return None
+
+# اضافه یا کم کردن یک دسته مشاهده (sign = 1 یا -1) به جدول‌های آمار
+def apply_price_changes(conn, changes):
+    buckets = collections.defaultdict(lambda: [0, 0.0, collections.Counter()])
+    weeks = collections.defaultdict(lambda: [0, 0.0])
+    for sign, key, week, price in changes:
+        bucket = buckets[key]
+        bucket[0] += sign
+        bucket[1] += sign * price
+        bucket[2][str(math.ceil(math.log(price, PRICE_GAMMA)))] += sign
+        week_total = weeks[key + (week,)]
+        week_total[0] += sign
+        week_total[1] += sign * price
+
+    for key, (count, total, sketch) in buckets.items():
+        row = conn.execute("SELECT count, total, sketch FROM price_stats WHERE brand = ? AND model = ? AND year = ?",
+                           key).fetchone()
+        if row:
+            count, total = count + row[0], total + row[1]
+            sketch.update(json.loads(row[2]))
+        sketch = {index: n for index, n in sketch.items() if n > 0}
+        if count > 0:
+            conn.execute("INSERT OR REPLACE INTO price_stats (brand, model, year, count, total, sketch) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", key + (count, total, json.dumps(sketch, sort_keys=True)))
+        else:
+            conn.execute("DELETE FROM price_stats WHERE brand = ? AND model = ? AND year = ?", key)
+    conn.executemany(
+        "INSERT INTO price_trends (brand, model, year, week, count, total) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (brand, model, year, week) DO UPDATE SET count = count + excluded.count, total = total + excluded.total",
+        [key + (count, total) for key, (count, total) in weeks.items()]
+    )
+    conn.execute("DELETE FROM price_trends WHERE count <= 0")
+
+def observe_price(conn, changes, channel, msg_id, posted_at, car):
+    price = car.get('price')
+    if not car.get('brand') or price is None or not price > 0:
+        return
+    key, week = price_key(car['brand'], car.get('model'), car.get('year')), price_week(posted_at)
+    group = conn.execute("SELECT group_id FROM fingerprints WHERE channel = ? AND msg_id = ?", (channel, msg_id)).fetchone()
+    changes.append((1, key, week, price))
+    conn.execute("INSERT INTO price_observations (channel, msg_id, brand, model, year, week, price, group_id) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (channel, msg_id) + key + (week, price, group[0] if group else None))
 
-            # وضعیت شاسی
-            chassis_match = re.search(r'شاسی\s*(سالم|تعمیر\s*شده|تعویض|آسیب\s*دیده)', text, re.IGNORECASE)
-            if chassis_match:
-                car['chassis_condition'] = chassis_match.group(1)
+# به‌روز کردن آمار با آگهی‌های ذخیره‌شده؛ entries: (کانال، شناسه‌ی پیام، تاریخ، فیلدها یا None)
+# مقدار قبلی پیام‌های ویرایش‌شده کم می‌شه؛ None یعنی پیام دیگه آگهی نیست. از هر گروه تکراری فقط اولین
+# انتشار (کمترین posted_at، مثل rebuild_price_stats) شمرده می‌شه، نه اولین پیامی که دریافت شده؛ تاریخچه‌ی
+# تلگرام جدیدترین پیام‌ها رو اول می‌ده، پس بازنشر معمولاً قبل از آگهی اصلی می‌رسه و اون موقع شمارش
+# گروه به آگهی اصلی منتقل می‌شه. گروه‌هایی که عضو شمرده‌شده‌شون رو از دست بدن هم همین‌طور
+def update_price_stats(conn, entries):
+    changes = []
+    groups = set()
+    for channel, msg_id, posted_at, car in entries:
+        old = conn.execute("SELECT brand, model, year, week, price, group_id FROM price_observations "
+                           "WHERE channel = ? AND msg_id = ?", (channel, msg_id)).fetchone()
+        if old:
+            changes.append((-1, tuple(old[:3]), old[3], old[4]))
+            conn.execute("DELETE FROM price_observations WHERE channel = ? AND msg_id = ?", (channel, msg_id))
+            if old[5] is not None:
+                groups.add(old[5])
+        if car:
+            group = conn.execute("SELECT group_id FROM fingerprints WHERE channel = ? AND msg_id = ?",
+                                 (channel, msg_id)).fetchone()
+            if group:
+                groups.add(group[0])
             else:
-                car['chassis_condition'] = "بدون اطلاعات"
+                observe_price(conn, changes, channel, msg_id, posted_at, car)
+
+    for group in groups:
+        first = conn.execute(
+            "SELECT l.channel, l.msg_id, l.posted_at, " + ", ".join('l.' + field for field in CAR_FIELDS)
+            + " FROM fingerprints f JOIN listings l ON l.channel = f.channel AND l.msg_id = f.msg_id"
+            + " WHERE f.group_id = ? ORDER BY l.posted_at, l.channel, l.msg_id LIMIT 1", (group,)
+        ).fetchone()
+        counted = conn.execute("SELECT channel, msg_id, brand, model, year, week, price FROM price_observations "
+                               "WHERE group_id = ?", (group,)).fetchone()
+        if counted and first and tuple(counted[:2]) == tuple(first[:2]):
+            continue
+        if counted:
+            changes.append((-1, tuple(counted[2:5]), counted[5], counted[6]))
+            conn.execute("DELETE FROM price_observations WHERE channel = ? AND msg_id = ?", tuple(counted[:2]))
+        if first:
+            observe_price(conn, changes, *first[:3], dict(zip(CAR_FIELDS, first[3:])))
+    apply_price_changes(conn, changes)
+
+# ساختن دوباره‌ی آمار قیمت از روی همه‌ی آگهی‌های ذخیره‌شده (هر گروه تکراری یک بار، اولین انتشار)
+# python main.py prices
+def rebuild_price_stats():
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT l.channel, l.msg_id, l.posted_at, f.group_id, " + ", ".join('l.' + field for field in CAR_FIELDS)
+        + " FROM listings l LEFT JOIN fingerprints f ON f.channel = l.channel AND f.msg_id = l.msg_id"
+        + " WHERE l.is_listing = 1 ORDER BY l.posted_at, l.channel, l.msg_id"
+    ).fetchall()
+    seen = set()
+    entries = []
+    for channel, msg_id, posted_at, group, *fields in rows:
+        if group is not None and group in seen:
+            continue
+        seen.add(group)
+        entries.append((channel, msg_id, posted_at, dict(zip(CAR_FIELDS, fields))))
+    with conn:
+        for table in ('price_stats', 'price_trends', 'price_observations'):
+            conn.execute(f"DELETE FROM {table}")
+        update_price_stats(conn, entries)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('price_stats_version', ?)",
+                     (str(PRICE_STATS_VERSION),))
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('data_version', '1') "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+    print(f"آمار قیمت از {len(entries)} آگهی ساخته شد")
+
+def price_stats_current():
+    row = get_db().execute("SELECT value FROM meta WHERE key = 'price_stats_version'").fetchone()
+    return row is not None and int(row[0]) == PRICE_STATS_VERSION
+
+# اعتبارسنجی دوباره‌ی همه‌ی آگهی‌های ذخیره‌شده بعد از تغییر قواعد (python main.py revalidate)
+# فقط آگهی‌هایی که وضعیتشون عوض شده با نسخه‌ی جدید نوشته می‌شن تا به کاربرهای /events هم برسن
+def revalidate_store():
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT rowid, " + ", ".join(CAR_FIELDS) + " FROM listings WHERE is_listing = 1"
+    ).fetchall()
+    df = pd.DataFrame(rows, columns=['rowid', *CAR_FIELDS])
+    start = time.perf_counter()
+    violations, status = validate_frame(df)
+    elapsed = time.perf_counter() - start
+    changed = (status != df['status']).to_numpy()
+    with conn:
+        version = get_data_version(conn) + 1
+        conn.executemany("UPDATE listings SET status = ?, version = ? WHERE rowid = ?",
+                         ((value, version, int(rowid)) for rowid, value in
+                          zip(df['rowid'][changed], status[changed])))
+        if changed.any():
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('data_version', ?)", (str(version),))
+    print(f"{len(df)} آگهی در {elapsed * 1000:.1f} میلی‌ثانیه اعتبارسنجی شد؛ وضعیت {int(changed.sum())} آگهی عوض شد")
+    for name, count in violations.sum().items():
+        print(f"  {name}: {int(count)}")
+
+# ذخیره‌ی پیام‌های دریافتی؛ فقط پیام‌های جدید یا ویرایش‌شده دوباره استخراج می‌شن
+# messages: لیستی از (کانال، شناسه‌ی پیام، تاریخ، متن)
+# خروجی: فیلدهای آگهی‌هایی که اضافه یا عوض شدن (بدون بازنشرهای تکراری)
+def store_messages(messages, watermarks=None):
+    conn = get_db()
+    pending = []
+    for channel, msg_id, posted_at, text in messages:
+        digest = content_hash(text)
+        row = conn.execute("SELECT content_hash FROM listings WHERE channel = ? AND msg_id = ?",
+                           (channel, msg_id)).fetchone()
+        if row and row[0] == digest:
+            continue
+        if hasattr(posted_at, 'isoformat'):
+            posted_at = posted_at.isoformat()
+        pending.append((channel, msg_id, posted_at, digest, text))
+
+    with timed('process_messages'):
+        results = extract_cars([text for *_, text in pending])
+    changed = len(pending)
+    with conn:
+        version = get_data_version(conn) + 1
+        conn.executemany(
+            "INSERT OR REPLACE INTO listings (channel, msg_id, posted_at, content_hash, raw_text, is_listing, version, "
+            + ", ".join(CAR_FIELDS) + ") VALUES (?, ?, ?, ?, ?, ?, ?" + ", ?" * len(CAR_FIELDS) + ")",
+            [[channel, msg_id, posted_at, digest, text.strip(), 1 if car else 0, version]
+             + [(car or {}).get(field) for field in CAR_FIELDS]
+             for (channel, msg_id, posted_at, digest, text), car in zip(pending, results)]
+        )
+        with timed('dedup'):
+            duplicates = assign_duplicate_groups(conn, [
+                (channel, msg_id, text, car) for (channel, msg_id, _, _, text), car in zip(pending, results)
+            ])
+        with timed('price_stats'):
+            update_price_stats(conn, [
+                (channel, msg_id, posted_at, car) for (channel, msg_id, posted_at, _, _), car in zip(pending, results)
+            ])
+
+        if watermarks:
+            conn.executemany(
+                "INSERT INTO watermarks (channel, max_id) VALUES (?, ?) "
+                "ON CONFLICT (channel) DO UPDATE SET max_id = MAX(max_id, excluded.max_id)",
+                list(watermarks.items())
+            )
+        if changed:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('data_version', ?)", (str(version),))
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('updated_at', ?)",
+                (datetime.now(timezone.utc).isoformat(),)
+            )
+    print(f"تعداد آگهی‌های جدید یا ویرایش‌شده: {changed} (تکراری: {len(duplicates)})")
+    return [car for (channel, msg_id, *_), car in zip(pending, results) if car and (channel, msg_id) not in duplicates]
+
+# تبدیل یک ستون به نوع فشرده‌اش؛ اگه عددی توی نوع کوچک جا نشه همون float64 می‌مونه
+def compact_column(series, dtype):
+    if dtype == 'category':
+        return series.astype('category')
+    if dtype == 'datetime':
+        return pd.to_datetime(series, utc=True, errors='coerce', format='ISO8601')
+    values = pd.to_numeric(series, errors='coerce')
+    if dtype.startswith('float'):
+        return values.astype(dtype)
+    limits = np.iinfo(dtype.lower())
+    present = values.dropna()
+    # نوع‌های با حرف کوچک (مثل int32) مقدار خالی قبول نمی‌کنن
+    if dtype.islower() and len(present) < len(values):
+        return values
+    if present.empty or (present.min() >= limits.min and present.max() <= limits.max):
+        return values.round().astype(dtype)
+    return values
+
+def compact_listings(df):
+    return df.assign(**{column: compact_column(df[column], dtype)
+                        for column, dtype in LISTING_DTYPES.items() if column in df.columns})
+
+# ردیف‌های یک صفحه به صورت dict برای قالب یا API؛ مقادیر خالی None می‌شن و تاریخ‌ها ISO
+def listing_records(page):
+    page = page.assign(**{column: page[column].map(pd.Timestamp.isoformat, na_action='ignore').astype(object)
+                          for column in page.columns if LISTING_DTYPES.get(column) == 'datetime'})
+    if 'price' in page.columns:
+        page = page.assign(price=page['price'].astype('float64').round(3))
+    return page.astype(object).where(page.notna(), None).to_dict('records')
+
+# هر گروه تکراری یک ردیف می‌شه: آخرین انتشار، به‌علاوه‌ی تعداد انتشار و کانال‌هایی که منتشرش کردن.
+# آگهی‌های بدون امضا (ذخیره‌شده قبل از تشخیص تکراری‌ها) هر کدوم گروه خودشونن
+def collapse_duplicates(df):
+    groups = df['group_id'].astype('float64').fillna(pd.Series(-1.0 - np.arange(len(df)), index=df.index))
+    ordered = df.assign(group=groups).sort_values('posted_at', kind='stable', na_position='first')
+    latest = ordered.drop_duplicates('group', keep='last').sort_index()
+    counts = groups.value_counts()
+    repeated = ordered[ordered['group'].map(counts).to_numpy() > 1].drop_duplicates(['group', 'channel'])
+    channels = repeated.groupby('group')['channel'].agg(lambda values: '، '.join(sorted(values)))
+    return latest.assign(
+        repost_count=latest['group'].map(counts).to_numpy(),
+        channels=latest['group'].map(channels).fillna(latest['channel']),
+    ).drop(columns=['group_id', 'group'])
+
+# خوندن آگهی‌ها از پایگاه‌داده (بدون متن کامل و با بازنشرها در یک ردیف)
+# برچسب خوشه فقط با مدل ذخیره‌شده داده می‌شه؛ درخواست‌های وب هیچ‌وقت مدل رو fit نمی‌کنن
+def load_listings(cluster=True):
+    df = pd.read_sql_query(
+        "SELECT l.channel, l.msg_id, l.posted_at, f.group_id, " + ", ".join('l.' + field for field in CAR_FIELDS)
+        + " FROM listings l LEFT JOIN fingerprints f ON f.channel = l.channel AND f.msg_id = l.msg_id"
+        + " WHERE l.is_listing = 1 ORDER BY l.channel, l.msg_id",
+        get_db()
+    )
+    df = collapse_duplicates(df).reset_index(drop=True)
+    if cluster:
+        df = cluster_cars(df, fit_missing=False)
+    return compact_listings(df)
+
+# آگهی‌هایی که بعد از نسخه‌ی داده‌شده اضافه یا عوض شدن
+def load_changed_keys(since_version):
+    return set(get_db().execute(
+        "SELECT channel, msg_id FROM listings WHERE version > ? AND is_listing = 1", (since_version,)
+    ).fetchall())
+
+# متن کامل آگهی‌ها برای (کانال، شناسه‌ی پیام)های داده‌شده
+def load_raw_texts(keys):
+    conn = get_db()
+    keys = [(str(channel), int(msg_id)) for channel, msg_id in keys]
+    texts = {}
+    for start in range(0, len(keys), 400):
+        chunk = keys[start:start + 400]
+        rows = conn.execute(
+            "SELECT channel, msg_id, raw_text FROM listings WHERE (channel, msg_id) IN (VALUES "
+            + ", ".join(["(?, ?)"] * len(chunk)) + ")",
+            [value for key in chunk for value in key]
+        ).fetchall()
+        texts.update(((channel, msg_id), text) for channel, msg_id, text in rows)
+    return texts
+
+# موتور جستجوی آگهی‌ها؛ هر بار که داده‌ها عوض می‌شن یک بار ساخته می‌شه و هر پرس‌وجو
+# تقریباً به اندازه‌ی نتیجه‌اش هزینه داره
+CATEGORY_FILTERS = ['brand', 'color', 'body_condition', 'chassis_condition', 'engine_condition']
+# ستون عددی: (مقدار جایگزین برای خالی، فیلتر حداقل، فیلتر حداکثر)
+RANGE_FILTERS = {
+    'price': (float('inf'), 'min_price', 'max_price'),
+    'year': (0, 'min_year', 'max_year'),
+    'mileage': (float('inf'), None, 'max_mileage'),
+}
+SORT_COLUMNS = ['price', 'year', 'mileage', 'posted_at', 'brand', 'deal_score']
+MODEL_NGRAM = 3
+
+def model_ngrams(text):
+    return {text[i:i + MODEL_NGRAM] for i in range(len(text) - MODEL_NGRAM + 1)}
+
+# جستجوی متنی در برند، مدل و متن آگهی‌ها
+# متن‌ها اول یکسان می‌شن (ارقام، «ي»/«ك»، اعراب، کشیده، نیم‌فاصله و چسبیدن عدد به حرف) و بعد به کلمه شکسته
+# می‌شن. برای هر کلمه لیست مرتب آگهی‌ها نگه داشته می‌شه و n-gram کلمه‌ها برای پیدا کردن کلمه‌هایی که متن
+# جستجو بخشی از اون‌هاست (مثل «توربو» در «پلاستوربو») استفاده می‌شه
+SEARCH_TITLE_BOOST = 3  # وزن کلمه‌ای که در برند یا مدل آگهی هست (در برابر ۱ برای متن)
+SEARCH_MAX_NUMBER = 6  # عددهای بلندتر (مثل شماره تلفن) ایندکس نمی‌شن
+SEARCH_MERGE_RATIO = 2  # تکه‌ی تازه وقتی با تکه‌ی قبلی ادغام می‌شه که حداقل نصفش باشه
+SEARCH_BATCH_SIZE = 50000  # ساختن اولیه‌ی ایندکس دسته‌دسته تا حافظه بالا نره
+
+# همون یکسان‌سازی normalize_text به‌علاوه‌ی حروف عربی دیگه، اعراب، کشیده و نویسه‌های نامرئی (یک translate)
+SEARCH_NORMALIZE_TABLE = {**NORMALIZE_TABLE, **str.maketrans({
+    'ة': 'ه', 'ۀ': 'ه', 'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ؤ': 'و', 'ئ': 'ی', 'ى': 'ی',
+    '‌': ' ',  # نیم‌فاصله
+    **{chr(code): None for code in (*range(0x064B, 0x0660), 0x0670, 0x0640, 0x200B, 0x200D, 0x200E, 0x200F, 0xFEFF)},
+})}
+# کلمه‌ها: عددها و حروف جدا از هم، پس «تیپ2» و «تیپ ۲» هر دو «تیپ 2» می‌شن؛ عددهای بلند کنار گذاشته می‌شن
+SEARCH_TOKEN = re.compile(r'(?<!\d)\d{1,%d}(?!\d)|[^\W\d_]+' % SEARCH_MAX_NUMBER)
+
+def search_tokens(text):
+    return SEARCH_TOKEN.findall(str(text).translate(SEARCH_NORMALIZE_TABLE).lower())
+
+def search_normalize(text):
+    return ' '.join(search_tokens(text))
+
+def search_terms(text):
+    return set(search_tokens(text))
+
+# ایندکس متنی آگهی‌ها؛ هر پروسه‌ی وب یکی داره و فقط آگهی‌هایی که نسخه‌شون از آخرین به‌روزرسانی
+# بیشتره دوباره خونده می‌شن. آگهی‌های تازه یک تکه‌ی جدا (لیست‌های مرتب numpy) می‌سازن و تکه‌های
+# کوچک با هم ادغام می‌شن؛ آگهی ویرایش‌شده شناسه‌ی جدید می‌گیره و شناسه‌ی قبلیش مرده علامت می‌خوره
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.terms = {}
+        self.term_names = []
+        self.term_ngrams = collections.defaultdict(set)
+        self.channels = {}
+        self.docs = {}
+        # آرایه‌های numpy در اولین به‌روزرسانی ساخته می‌شن تا import برنامه numpy رو بارگذاری نکنه
+        self.counts = None
+        self.doc_keys = None
+        self.alive = None
+        # هر تکه: (offsets روی شناسه‌ی کلمه، شناسه‌ی آگهی‌ها، وزن‌ها)؛ شناسه‌ی آگهی‌های هر تکه از قبلی‌ها بزرگ‌تره
+        self.segments = []
+
+    def _key(self, channel, msg_id):
+        return self.channels.setdefault(channel, len(self.channels)) << 40 | int(msg_id)
+
+    def _term_ids(self, terms):
+        ids = np.empty(len(terms), dtype=np.int64)
+        for i, term in enumerate(terms):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                term_id = self.terms[term] = len(self.terms)
+                self.term_names.append(term)
+                if not term.isdigit():
+                    for gram in model_ngrams(term):
+                        self.term_ngrams[gram].add(term_id)
+            ids[i] = term_id
+        return ids
+
+    # اضافه کردن (یا جایگزین کردن) آگهی‌ها؛ entries: (کانال، شناسه‌ی پیام، عنوان، متن) یا متن None برای حذف
+    def update(self, entries):
+        with self.lock:
+            if self.alive is None:
+                self.counts = np.zeros(0, dtype=np.int64)
+                self.doc_keys = np.zeros(0, dtype=np.int64)
+                self.alive = np.zeros(0, dtype=bool)
+            keys, removed = [], []
+            # کلمه‌های عنوان و متن جدا جمع می‌شن و وزن هر (کلمه، آگهی) بعداً یک‌جا با numpy حساب می‌شه
+            terms, docs, lengths = [], [], []
+            for channel, msg_id, title, text in entries:
+                key = self._key(channel, msg_id)
+                previous = self.docs.pop(key, None)
+                if previous is not None:
+                    removed.append(previous)
+                if text is None:
+                    continue
+                doc = len(self.doc_keys) + len(keys)
+                self.docs[key] = doc
+                keys.append(key)
+                for field in (search_terms(title), search_terms(text)):
+                    terms.extend(field)
+                    docs.append(doc)
+                    lengths.append(len(field))
+            if not keys:
+                self._forget(removed)
+                return
+            # کلمه‌ها فقط یک بار برای هر کلمه‌ی یکتای این دسته به شناسه تبدیل می‌شن
+            codes, uniques = pd.factorize(np.array(terms, dtype=object))
+            term_ids = self._term_ids(list(uniques))[codes]
+            lengths = np.array(lengths, dtype=np.int64)
+            docs = np.repeat(np.array(docs, dtype=np.int64), lengths)
+            field_weights = np.tile(np.array([SEARCH_TITLE_BOOST, 1], dtype=np.int64), len(keys))
+            # (کلمه، آگهی)های تکراری (هم در عنوان و هم در متن) یکی می‌شن و وزن‌هاشون جمع می‌شه؛
+            # خروجی np.unique به ترتیب کلمه و بعد آگهیه، همون ترتیبی که تکه لازم داره
+            base = len(self.doc_keys) + len(keys)
+            pairs, inverse = np.unique(term_ids * base + docs, return_inverse=True)
+            weights = np.bincount(inverse.reshape(-1), weights=np.repeat(field_weights, lengths)).astype(np.uint8)
+            term_ids, docs = pairs // base, (pairs % base).astype(np.int32)
+
+            self.doc_keys = np.concatenate([self.doc_keys, np.array(keys, dtype=np.int64)])
+            self.alive = np.concatenate([self.alive, np.ones(len(keys), dtype=bool)])
+            self.counts = np.concatenate([self.counts, np.zeros(len(self.terms) - len(self.counts), dtype=np.int64)])
+            self.counts += np.bincount(term_ids, minlength=len(self.terms))
+            self.segments.append(self._segment(term_ids, docs, weights))
+            # آگهی‌ای که در همین دسته دو بار اومده هم حالا در تکه‌ی جدیده و مثل بقیه کم می‌شه
+            self._forget(removed)
+            while len(self.segments) > 1 and \
+                    len(self.segments[-1][1]) * SEARCH_MERGE_RATIO >= len(self.segments[-2][1]):
+                self.segments[-2:] = [self._merge(*self.segments[-2:])]
+
+    # آگهی‌های حذف‌شده مرده علامت می‌خورن و کلمه‌هاشون از تعداد آگهی‌های هر کلمه (برای idf) کم می‌شه؛
+    # کلمه‌های هر آگهی جدا نگه داشته نمی‌شن، پس از روی جای آگهی در تکه‌ها پیدا می‌شن
+    def _forget(self, removed):
+        if not removed:
+            return
+        self.alive[removed] = False
+        dead = np.zeros(len(self.alive), dtype=bool)
+        dead[removed] = True
+        for offsets, docs, _ in self.segments:
+            postings = np.flatnonzero(dead[docs])
+            if len(postings):
+                self.counts -= np.bincount(np.searchsorted(offsets, postings, side='right') - 1,
+                                           minlength=len(self.counts))
+
+    # term_ids باید مرتب باشه (و آگهی‌های هر کلمه هم مرتب)
+    def _segment(self, term_ids, docs, weights):
+        return np.searchsorted(term_ids, np.arange(len(self.terms) + 1)), docs, weights
+
+    # ادغام دو تکه‌ی پشت‌سرهم؛ آگهی‌های مرده همین‌جا دور ریخته می‌شن
+    def _merge(self, first, second):
+        term_ids = np.concatenate([np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+                                   for offsets, _, _ in (first, second)])
+        docs = np.concatenate([first[1], second[1]])
+        weights = np.concatenate([first[2], second[2]])
+        keep = self.alive[docs]
+        # آگهی‌های تکه‌ی دوم همه از تکه‌ی اول بزرگ‌ترن، پس مرتب‌سازی پایدار روی کلمه کافیه
+        order = np.argsort(term_ids[keep], kind='stable')
+        return self._segment(term_ids[keep][order], docs[keep][order], weights[keep][order])
+
+    # شناسه‌ی کلمه‌هایی که با یک کلمه‌ی جستجو می‌خونن: عدد و کلمه‌ی کوتاه دقیقاً، بقیه به صورت بخشی از کلمه
+    def _expand(self, term):
+        if term.isdigit() or len(term) < MODEL_NGRAM:
+            return [self.terms[term]] if term in self.terms else []
+        postings = sorted((self.term_ngrams.get(gram, set()) for gram in model_ngrams(term)), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        return [term_id for term_id in candidates if term in self.term_names[term_id]]
+
+    # آگهی‌هایی که همه‌ی کلمه‌های جستجو رو دارن (شناسه‌ی مرتب) و امتیازشون (مجموع idf × وزن)
+    def match(self, query):
+        with self.lock:
+            if self.alive is None:
+                return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+            total = max(int(self.alive.sum()), 1)
+            result, scores = None, None
+            for term in dict.fromkeys(search_normalize(query).split()):
+                term_ids = self._expand(term)
+                parts = [(segment[1][segment[0][term_id]:segment[0][term_id + 1]],
+                          segment[2][segment[0][term_id]:segment[0][term_id + 1]]
+                          * np.float32(math.log(1 + total / self.counts[term_id])))
+                         for term_id in term_ids if self.counts[term_id]
+                         for segment in self.segments if term_id < len(segment[0]) - 1]
+                docs = np.concatenate([docs for docs, _ in parts]) if parts else np.zeros(0, dtype=np.int32)
+                weights = np.concatenate([weights for _, weights in parts]) if parts else np.zeros(0, dtype=np.float32)
+                keep = self.alive[docs]
+                docs, weights = docs[keep], weights[keep]
+                if len(term_ids) > 1:
+                    # یک آگهی ممکنه چند کلمه‌ی منطبق داشته باشه؛ بیشترین امتیاز حساب می‌شه
+                    docs, inverse = np.unique(docs, return_inverse=True)
+                    best = np.zeros(len(docs), dtype=np.float32)
+                    np.maximum.at(best, inverse, weights)
+                    weights = best
+                if result is None:
+                    result, scores = docs, weights
+                else:
+                    result, left, right = np.intersect1d(result, docs, assume_unique=True, return_indices=True)
+                    scores = scores[left] + weights[right]
+                if not len(result):
+                    break
+            if result is None:
+                return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+            return result, scores
 
-            # وضعیت موتور
-            engine_match = re.search(r'موتور\s*(سالم|تعمیر\s*شده|تعویض|نیاز به تعمیر)', text, re.IGNORECASE)
-            if engine_match:
-                car['engine_condition'] = engine_match.group(1)
+    # شماره‌ی ردیف هر آگهی در یک جدول آگهی‌ها (‎-1 برای آگهی‌هایی که در جدول نیستن، مثل بازنشرها)
+    def positions(self, df):
+        with self.lock:
+            channels = np.array([self.channels.get(channel, -1) for channel in df['channel'].cat.categories], dtype=np.int64) \
+                if isinstance(df['channel'].dtype, pd.CategoricalDtype) else None
+            doc_keys = self.doc_keys if self.doc_keys is not None else np.zeros(0, dtype=np.int64)
+        if channels is not None:
+            codes = df['channel'].cat.codes.to_numpy()
+            channel_codes = np.where(codes >= 0, channels[codes], -1)
+        else:
+            channel_codes = np.array([self.channels.get(channel, -1) for channel in df['channel']], dtype=np.int64)
+        # ردیف‌های کانال ناشناخته کلید منفی یکتا می‌گیرن تا با هیچ آگهی‌ای جور نشن
+        keys = np.where(channel_codes >= 0, channel_codes << 40 | df['msg_id'].to_numpy(dtype=np.int64),
+                        -1 - np.arange(len(df)))
+        return pd.Index(keys).get_indexer(doc_keys)
+
+    # خوندن آگهی‌هایی که بعد از آخرین به‌روزرسانی اضافه، ویرایش یا حذف شدن
+    def refresh(self, conn=None):
+        conn = conn or get_db()
+        latest = conn.execute("SELECT MAX(version) FROM listings").fetchone()[0] or 0
+        if self.version is not None and latest <= self.version:
+            return
+        query = "SELECT channel, msg_id, is_listing, brand, model, raw_text FROM listings"
+        cursor = conn.execute(query + " WHERE is_listing = 1" if self.version is None else query + " WHERE version > ?",
+                              () if self.version is None else (self.version,))
+        while True:
+            rows = cursor.fetchmany(SEARCH_BATCH_SIZE)
+            if not rows:
+                break
+            self.update([(channel, msg_id, f"{brand or ''} {model or ''}", raw_text if is_listing else None)
+                         for channel, msg_id, is_listing, brand, model, raw_text in rows])
+        self.version = latest
+        metrics.set('car_filter_search_terms', len(self.terms))
+
+search_index = SearchIndex()
+
+class ListingIndex:
+    # search: ایندکس متنی (SearchIndex) برای پارامتر q؛ بدونش جستجوی متنی نتیجه‌ای نداره
+    def __init__(self, df, search=None):
+        self.size = len(df)
+
+        # ستون‌های دسته‌ای به کد تبدیل می‌شن و برای هر کد لیست مرتب ردیف‌ها نگه داشته می‌شه
+        self.codes = {}
+        self.lookup = {}
+        self.postings = {}
+        # ستون‌های categorical جدول فشرده کدهاشون رو دارن و دوباره hash نمی‌شن
+        for column in CATEGORY_FILTERS + ['model']:
+            categorical = pd.Categorical(df[column])
+            codes = categorical.codes.astype(np.int64)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(categorical.categories) + 1))
+            self.codes[column] = codes
+            self.lookup[column] = {value: code for code, value in enumerate(categorical.categories)}
+            self.postings[column] = [order[bounds[i]:bounds[i + 1]] for i in range(len(categorical.categories))]
+
+        # ستون‌های عددی یک بار مرتب می‌شن تا بازه‌ها با searchsorted پیدا بشن
+        self.values = {}
+        self.sorted = {}
+        for column, (fill, _, _) in RANGE_FILTERS.items():
+            values = df[column].to_numpy(dtype=float, na_value=np.nan)
+            values[np.isnan(values)] = fill
+            order = np.argsort(values, kind='stable')
+            self.values[column] = values
+            self.sorted[column] = (values[order], order)
+
+        # فیلتر مدل روی «برند مدل» یکسان‌شده‌ی هر ردیف انجام می‌شه (مثل «206 تیپ 2»)؛ فقط ترکیب‌های
+        # یکتا نگه داشته می‌شن و n-gram اون‌ها برای جستجوی بخشی از عنوان استفاده می‌شه
+        brands, models = list(self.lookup['brand']), list(self.lookup['model'])
+        pairs = self.codes['brand'] * (len(models) + 1) + self.codes['model'] + 1
+        codes, uniques = pd.factorize(pairs)
+        self.codes['title'] = codes.astype(np.int64)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        self.postings['title'] = [order[bounds[i]:bounds[i + 1]] for i in range(len(uniques))]
+        self.titles = []
+        for pair in uniques:
+            brand, model = divmod(int(pair), len(models) + 1)
+            self.titles.append(search_normalize(f"{brands[brand] if brand >= 0 else ''} {models[model - 1] if model else ''}"))
+        self.title_ngrams = collections.defaultdict(set)
+        for code, title in enumerate(self.titles):
+            for gram in model_ngrams(title):
+                self.title_ngrams[gram].add(code)
+
+        self.search = search
+        self.search_positions = search.positions(df) if search is not None else None
+
+    # کد عنوان‌هایی که متن جستجو (یکسان‌شده) بخشی از اون‌هاست
+    def match_models(self, text):
+        text = search_normalize(text)
+        candidates = range(len(self.titles))
+        if len(text) >= MODEL_NGRAM:
+            postings = sorted((self.title_ngrams.get(gram, set()) for gram in model_ngrams(text)), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        return np.array(sorted(code for code in candidates if text in self.titles[code]), dtype=np.int64)
+
+    # ردیف‌های (مرتب) منطبق با جستجوی متنی و امتیاز هر کدوم
+    def match_text(self, query):
+        if self.search is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        docs, scores = self.search.match(query)
+        # آگهی‌هایی که بعد از ساختن این جدول به ایندکس اضافه شدن اینجا نیستن
+        known = docs < len(self.search_positions)
+        positions = self.search_positions[docs[known]]
+        scores = scores[known]
+        present = positions >= 0
+        order = np.argsort(positions[present], kind='stable')
+        return positions[present][order], scores[present][order]
+
+    # امتیاز جستجوی متنی هر ردیف (صفر برای ردیف‌هایی که نمی‌خونن)
+    def relevance(self, query, positions):
+        matched, scores = self.match_text(query)
+        relevance = np.zeros(len(positions), dtype=np.float32)
+        if len(matched):
+            index = np.minimum(np.searchsorted(matched, positions), len(matched) - 1)
+            hit = matched[index] == positions
+            relevance[hit] = scores[index[hit]]
+        return relevance
+
+    # مرتب‌سازی ردیف‌ها بر اساس امتیاز جستجوی متنی (بیشترین اول؛ امتیاز برابر به ترتیب جدول)
+    def rank(self, query, positions):
+        return positions[np.argsort(-self.relevance(query, positions), kind='stable')]
+
+    # هر شرط به صورت (تعداد ردیف‌ها، ساختن لیست ردیف‌ها، بررسی ردیف‌های داده‌شده)
+    def _conditions(self, filters):
+        conditions = []
+        for column in CATEGORY_FILTERS:
+            value = filters.get(column)
+            if not value:
+                continue
+            code = self.lookup[column].get(value)
+            rows = self.postings[column][code] if code is not None else np.empty(0, dtype=np.int64)
+            conditions.append((
+                len(rows),
+                lambda rows=rows: rows,
+                lambda positions, column=column, code=code: self.codes[column][positions] == code,
+            ))
+
+        if filters.get('model'):
+            codes = self.match_models(filters['model'])
+            postings = [self.postings['title'][code] for code in codes]
+            conditions.append((
+                sum(len(rows) for rows in postings),
+                lambda: np.sort(np.concatenate(postings)) if postings else np.empty(0, dtype=np.int64),
+                lambda positions: np.isin(self.codes['title'][positions], codes),
+            ))
+
+        if filters.get('q'):
+            matched, _ = self.match_text(filters['q'])
+            conditions.append((
+                len(matched),
+                lambda: matched,
+                lambda positions: np.isin(positions, matched),
+            ))
+
+        for column, (_, min_key, max_key) in RANGE_FILTERS.items():
+            low = filters.get(min_key, float('-inf')) if min_key else float('-inf')
+            high = filters.get(max_key, float('inf'))
+            sorted_values, order = self.sorted[column]
+            start = np.searchsorted(sorted_values, low, side='left')
+            end = np.searchsorted(sorted_values, high, side='right')
+            if start == 0 and end == self.size:
+                continue
+            values = self.values[column]
+            conditions.append((
+                max(end - start, 0),
+                lambda order=order, start=start, end=end: np.sort(order[start:end]),
+                lambda positions, values=values, low=low, high=high: (values[positions] >= low) & (values[positions] <= high),
+            ))
+        return conditions
+
+    # شماره‌ی ردیف‌هایی که با همه‌ی فیلترها می‌خونن (به ترتیب جدول)؛ filters=None یعنی همه‌ی ردیف‌ها
+    def query(self, filters=None):
+        conditions = self._conditions(filters or {})
+        if not conditions:
+            return np.arange(self.size)
+        # از شرطی که کمترین ردیف رو داره شروع کن و بقیه رو فقط روی همون ردیف‌ها بررسی کن
+        conditions.sort(key=lambda condition: condition[0])
+        positions = conditions[0][1]()
+        for _, _, check in conditions[1:]:
+            if not len(positions):
+                break
+            positions = positions[check(positions)]
+        return positions
+
+# مرتب‌سازی ردیف‌ها بر اساس یک ستون؛ «-» اول اسم ستون یعنی نزولی. ردیف‌های بی‌مقدار آخر میان
+def sort_positions(df, positions, key):
+    if not key:
+        return positions
+    column = key.lstrip('-')
+    if column not in SORT_COLUMNS:
+        raise ValueError(f"مرتب‌سازی بر اساس {column} پشتیبانی نمی‌شه")
+    series = df[column]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # دسته‌ها به ترتیب الفبا هستن، پس مرتب‌سازی روی کدها همون ترتیب متن‌هاست
+        values = series.cat.codes.to_numpy()[positions]
+        missing = values < 0
+    else:
+        values = series.to_numpy(dtype=float, na_value=np.nan) if pd.api.types.is_numeric_dtype(series.dtype) \
+            else series.to_numpy()
+        values = values[positions]
+        missing = pd.isna(values)
+    present = positions[~missing]
+    order = np.argsort(values[~missing], kind='stable')
+    if key.startswith('-'):
+        order = order[::-1]
+    return np.concatenate([present[order], positions[missing]])
+
+def _parse_number(values, key, default):
+    value = values.get(key)
+    if value in (None, ''):
+        return default
+    return float(value)
+
+# تبدیل مقادیر فرم یا query string به فیلترهای موتور جستجو
+# متن‌ها مثل متن آگهی‌ها یکسان‌سازی می‌شن (مثلاً «۲۰۷» و «207» یک فیلترن)
+def parse_filters(values):
+    filters = {column: normalize_text(values.get(column) or '').strip() or None
+               for column in CATEGORY_FILTERS + ['model']}
+    filters.update(
+        min_price=_parse_number(values, 'min_price', 0),
+        max_price=_parse_number(values, 'max_price', float('inf')),
+        min_year=_parse_number(values, 'min_year', 0),
+        max_year=_parse_number(values, 'max_year', 9999),
+        max_mileage=_parse_number(values, 'max_mileage', float('inf')),
+    )
+    # جستجوی متنی آزاد در برند، مدل و متن آگهی؛ یکسان‌شده تا کلید cache هم برای همه‌ی شکل‌های نوشتاری یکی باشه
+    filters['q'] = search_normalize(values.get('q') or '') or None
+    return filters
+
+# cache نتیجه‌ی جستجوها؛ کلید از فیلترهای یکسان‌شده، مرتب‌سازی، نسخه‌ی داده و تعداد ردیف‌ها ساخته می‌شه، پس با
+# هر دریافت جدید خودبه‌خود باطل می‌شه. یک لایه در حافظه (LRU با TTL) و یک لایه‌ی اختیاری
+# SQLite که بین چند پروسه‌ی وب مشترکه
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL = 600  # ثانیه
+QUERY_CACHE_MAX_ROWS = 100000  # نتیجه‌های بزرگ‌تر cache نمی‌شن
+QUERY_CACHE_PATH = None  # مثلاً 'query_cache.db' برای cache مشترک بین پروسه‌ها
+
+class QueryCache:
+    def __init__(self, size, ttl, path=None):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.local = threading.local()
+
+    def _shared(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None and self.path:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_cache ("
+                "key TEXT PRIMARY KEY, version INTEGER NOT NULL, expires REAL NOT NULL, positions BLOB NOT NULL)"
+            )
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(version, size, filters, sort):
+        return hashlib.sha1(json.dumps([version, size, filters, sort], sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, positions = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    return positions
+                del self.entries[key]
+
+        conn = self._shared()
+        if conn is not None:
+            row = conn.execute("SELECT expires, positions FROM query_cache WHERE key = ?", (key,)).fetchone()
+            if row and row[0] > now:
+                positions = np.frombuffer(row[1], dtype=np.int64)
+                self._remember(key, row[0], positions)
+                return positions
+        return None
+
+    def put(self, key, version, positions):
+        if len(positions) > QUERY_CACHE_MAX_ROWS:
+            return
+        positions = np.asarray(positions, dtype=np.int64)
+        expires = time.time() + self.ttl
+        self._remember(key, expires, positions)
+        conn = self._shared()
+        if conn is not None:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO query_cache (key, version, expires, positions) VALUES (?, ?, ?, ?)",
+                             (key, version, expires, positions.tobytes()))
+
+    def _remember(self, key, expires, positions):
+        with self.lock:
+            self.entries[key] = (expires, positions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # وقتی نسخه‌ی داده عوض می‌شه نتیجه‌های قدیمی پاک می‌شن
+    def invalidate(self, version):
+        with self.lock:
+            if self.version == version:
+                return
+            self.version = version
+            self.entries.clear()
+        conn = self._shared()
+        if conn is not None:
+            with conn:
+                conn.execute("DELETE FROM query_cache WHERE version < ? OR expires < ?", (version, time.time()))
+
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_PATH)
+
+# جستجو با استفاده از cache؛ شماره‌ی ردیف‌های نتیجه (مرتب‌شده اگه sort داده شده باشه)
+def cached_query(version, df, listing_index, filters, sort=None):
+    # تعداد ردیف‌ها هم جزو کلیده و نتیجه‌ای که به بیرون جدول اشاره کنه استفاده نمی‌شه
+    key = QueryCache.make_key(version, len(df), filters, sort)
+    positions = query_cache.get(key)
+    if positions is not None and len(positions) and positions.max() >= len(df):
+        positions = None
+    metrics.inc('car_filter_cache_requests_total', cache='query', result='hit' if positions is not None else 'miss')
+    if positions is None:
+        with timed('filter'):
+            positions = listing_index.query(filters)
+            # با جستجوی متنی و بدون مرتب‌سازی، مرتبط‌ترین آگهی‌ها اول میان
+            if not sort and filters and filters.get('q'):
+                positions = listing_index.rank(filters['q'], positions)
             else:
-                car['engine_condition'] = "بدون اطلاعات"
+                positions = sort_positions(df, positions, sort)
+        query_cache.put(key, version, positions)
+    return positions
+
+# خلاصه‌ی آمار قیمت همه‌ی گروه‌ها در حافظه (برای هر نسخه‌ی داده یک بار)؛ هر جستجو یک lookup در dict
+price_lock = threading.Lock()
+_price_cache = {'version': None, 'stats': {}, 'by_brand': {}}
+
+def summarize_price_bucket(key, count, total, sketch, trend):
+    summary = {'brand': key[0], 'model': key[1], 'year': key[2] or None, 'count': count,
+               'mean': round(total / count, 3)}
+    summary.update((name, round(sketch_quantile(sketch, count, q), 3)) for name, q in PRICE_QUANTILES.items())
+    summary['trend'] = [{'week': week, 'count': n, 'mean': round(week_total / n, 3)}
+                        for week, n, week_total in sorted(trend)]
+    return summary
+
+def get_price_stats():
+    version = get_data_version()
+    with price_lock:
+        if _price_cache['version'] != version:
+            with timed('load_price_stats'):
+                conn = get_db()
+                since = price_week((datetime.now(timezone.utc) - timedelta(weeks=PRICE_TREND_WEEKS)).isoformat())
+                trends = collections.defaultdict(list)
+                for brand, model, year, week, count, total in conn.execute(
+                        "SELECT brand, model, year, week, count, total FROM price_trends WHERE week >= ?", (since,)):
+                    trends[(brand, model, year)].append((week, count, total))
+                stats = {}
+                by_brand = collections.defaultdict(list)
+                for brand, model, year, count, total, sketch in conn.execute(
+                        "SELECT brand, model, year, count, total, sketch FROM price_stats"):
+                    key = (brand, model, year)
+                    stats[key] = summarize_price_bucket(key, count, total, json.loads(sketch), trends.get(key, []))
+                    by_brand[brand].append(stats[key])
+            _price_cache.update(version=version, stats=stats, by_brand=dict(by_brand))
+            metrics.set('car_filter_price_buckets', len(stats))
+        return _price_cache['stats'], _price_cache['by_brand']
+
+# امتیاز خرید هر آگهی: چقدر ارزون‌تر از میانه‌ی گروه خودشه ((میانه - قیمت) / میانه)؛
+# مثبت یعنی زیر قیمت بازار. گروه‌های کم‌آگهی امتیاز ندارن
+def deal_scores(df):
+    stats, _ = get_price_stats()
+    medians = pd.Series({key: summary['median'] for key, summary in stats.items()
+                         if summary['count'] >= PRICE_MIN_COUNT}, dtype='float64')
+    if df.empty or medians.empty:
+        return np.full(len(df), np.nan, dtype=np.float32)
+    models = df['model'].astype('category')
+    model_keys = pd.Index(models.cat.categories.astype(str).str.strip().str.lower())
+    keys = pd.MultiIndex.from_arrays([
+        df['brand'].astype(object).to_numpy(),
+        np.where(models.cat.codes.to_numpy() >= 0, model_keys.to_numpy()[models.cat.codes.to_numpy()], ''),
+        df['year'].fillna(0).astype('int64').to_numpy(),
+    ])
+    median = medians.reindex(keys).to_numpy()
+    price = df['price'].to_numpy(dtype=float, na_value=np.nan)
+    return ((median - price) / median).astype(np.float32)
+
+# جدول آگهی‌ها و موتور جستجو تا وقتی نسخه‌ی داده عوض نشه دوباره ساخته نمی‌شن
+listings_lock = threading.Lock()
+_listings_cache = {'version': None, 'cluster_mtime': None, 'df': None, 'index': None}
+
+def get_snapshot():
+    version = get_data_version()
+    cluster_mtime = cluster_model_mtime()
+    with listings_lock:
+        if _listings_cache['version'] != version or _listings_cache['cluster_mtime'] != cluster_mtime:
+            # نسخه و جدول در یک تراکنش خوندنی خونده می‌شن؛ وگرنه دریافتی که بینشون ذخیره بشه جدول جدیدتر
+            # رو با نسخه‌ی قدیمی‌تر cache می‌کنه و نتیجه‌های cache مشترک به ردیف‌های اشتباه اشاره می‌کنن
+            conn = get_db()
+            conn.execute("BEGIN")
+            try:
+                version = get_data_version(conn)
+                with timed('load_snapshot'):
+                    df = load_listings().reindex(columns=LISTING_COLUMNS).reset_index(drop=True)
+                    df['deal_score'] = deal_scores(df)
+                # ایندکس متنی فقط آگهی‌هایی رو که از دفعه‌ی قبل تغییر کردن می‌خونه
+                with timed('search_index'):
+                    search_index.refresh(conn)
+                    listing_index = ListingIndex(df, search=search_index)
+            finally:
+                conn.rollback()
+            _listings_cache.update(version=version, cluster_mtime=cluster_mtime, df=df, index=listing_index)
+            query_cache.invalidate(version)
+            metrics.set('car_filter_listings', len(df))
+            metrics.set('car_filter_listings_bytes', int(df.memory_usage(deep=True).sum()))
+            metrics.set('car_filter_data_version', version)
+        return _listings_cache['version'], _listings_cache['df'], _listings_cache['index']
+
+# یک نوبت دریافت: فقط پیام‌های جدید هر کانال گرفته و در پایگاه‌داده ذخیره می‌شن
+# اگه وسط دریافت lease از دست بره (stop) چیزی ذخیره نمی‌شه؛ پروسه‌ی دیگه همین پیام‌ها رو می‌گیره
+def run_ingestion_cycle(stop=None):
+    watermarks = load_watermarks()
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        new_messages = loop.run_until_complete(fetch_messages(watermarks))
+    finally:
+        loop.close()
+
+    if stop is not None and stop.is_set():
+        print("lease دریافت از دست رفت؛ پیام‌های این نوبت ذخیره نمی‌شن")
+        return
+    print(f"تعداد پیام‌های جدید در این نوبت: {len(new_messages)}")
+    ingest_messages(new_messages, watermarks)
+
+# اعلان تغییر داده‌ها به streamهای /events همین پروسه (پروسه‌های دیگه با poll نسخه‌ی داده باخبر می‌شن)
+data_changed = threading.Condition()
+
+def notify_data_changed():
+    with data_changed:
+        data_changed.notify_all()
 
-            if (car.get('brand') or car.get('model')) and (car.get('year') or car.get('price') is not None):
-                car['status'] = validate_data(car)
-                cars.append(car)
+def wait_for_data_change(timeout):
+    with data_changed:
+        data_changed.wait(timeout)
+
+# ذخیره‌ی پیام‌های مرتبط و به‌روز کردن مدل خوشه‌بندی (همین‌جا و نه موقع درخواست)
+def ingest_messages(messages, watermarks=None):
+    new_listings = store_messages(messages, watermarks)
+    if not price_stats_current():
+        rebuild_price_stats()
+    if load_cluster_model() is None:
+        update_cluster_model(load_listings(cluster=False))
+    elif new_listings:
+        update_cluster_model(pd.DataFrame(new_listings, columns=CAR_FIELDS))
+    if messages:
+        notify_data_changed()
+    return new_listings
+
+# حلقه‌ی زمان‌بند دریافت که در یک thread جدا اجرا می‌شه
+# حلقه تا set شدن stop ادامه داره
+def ingestion_worker(stop):
+    while not stop.is_set():
+        try:
+            run_ingestion_cycle(stop)
+        except Exception as e:
+            print(f"خطا در دریافت دوره‌ای پیام‌ها: {e}")
+        stop.wait(FETCH_INTERVAL)
+
+# پردازش یک دسته پیامی که در حالت زنده رسیده
+def process_live_batch(batch, stop):
+    if stop.is_set():
+        return
+    relevant = filter_relevant([text for *_, text in batch])
+    watermarks = {}
+    for channel, msg_id, _, _ in batch:
+        watermarks[channel] = max(watermarks.get(channel, 0), msg_id)
+        metrics.inc('car_filter_fetched_messages_total', channel=channel)
+    ingest_messages([msg for msg, keep in zip(batch, relevant) if keep], watermarks)
+
+# گوش دادن به پیام‌های جدید (و ویرایش‌شده‌ی) کانال‌ها با events.NewMessage؛ پیام‌هایی که در
+# LIVE_BATCH_WINDOW ثانیه می‌رسن با هم و در یک thread جدا پردازش می‌شن تا اتصال تلگرام معطل نمونه
+async def listen_channels(stop):
+    from telethon import events, utils
+    async with TelegramClient('session', API_ID, API_HASH) as client:
+        await client.start(phone=PHONE)
+        channels = {}
+        for channel in channel_list:
+            try:
+                channels[utils.get_peer_id(await resolve_entity(client, channel))] = channel
+            except Exception as e:
+                print(f"خطا در پیدا کردن کانال {channel}: {e}")
+                metrics.inc('car_filter_fetch_errors_total', channel=channel)
+
+        queue = asyncio.Queue()
+
+        async def on_message(event):
+            if event.message.message:
+                queue.put_nowait((channels[event.chat_id], event.message.id, event.message.date, event.message.message))
+
+        client.add_event_handler(on_message, events.NewMessage(chats=list(channels)))
+        client.add_event_handler(on_message, events.MessageEdited(chats=list(channels)))
+        print(f"حالت زنده: گوش دادن به {len(channels)} کانال")
+
+        loop = asyncio.get_running_loop()
+        while client.is_connected() and not stop.is_set():
+            try:
+                batch = [await asyncio.wait_for(queue.get(), LIVE_RETRY_INTERVAL)]
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(LIVE_BATCH_WINDOW)
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                with timed('live_batch'):
+                    await loop.run_in_executor(None, process_live_batch, batch, stop)
+            except Exception as e:
+                print(f"خطا در پردازش پیام‌های زنده: {e}")
+
+# حالت زنده: اول پیام‌هایی که از آخرین اجرا جا موندن گرفته می‌شن، بعد به پیام‌های جدید گوش داده می‌شه
+def live_worker(stop):
+    while not stop.is_set():
+        try:
+            run_ingestion_cycle(stop)
+            loop = asyncio.new_event_loop()
+            try:
+                asyncio.set_event_loop(loop)
+                loop.run_until_complete(listen_channels(stop))
+            finally:
+                loop.close()
         except Exception as e:
-            print(f"خطا در پردازش پیام: {e}")
+            print(f"خطا در حالت زنده: {e}")
+        stop.wait(LIVE_RETRY_INTERVAL)
+
+def start_ingestion(live=False, stop=None):
+    stop = stop or threading.Event()
+    thread = threading.Thread(target=live_worker if live else ingestion_worker, args=(stop,), name='ingestion',
+                              daemon=True)
+    thread.start()
+    return thread
+
+# lease پروسه‌ی دریافت: اگه پروسه‌ی دیگه‌ای lease معتبر داشته باشه False برمی‌گردونه
+def acquire_fetcher_lease(owner):
+    conn = get_db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'fetcher_lease'").fetchone()
+        if row:
+            lease = json.loads(row[0])
+            if lease['owner'] != owner and lease['expires'] > now and not lease_holder_dead(lease['owner']):
+                conn.rollback()
+                return False
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fetcher_lease', ?)",
+                     (json.dumps({'owner': owner, 'expires': now + FETCHER_LEASE_TTL}),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+# صاحب lease روی همین ماشین که دیگه اجرا نمی‌شه (مثلاً پروسه‌ی قبلی reloader یا پروسه‌ای که crash کرده)
+def lease_holder_dead(holder):
+    host, _, pid = holder.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    return process_dead(int(pid))
+
+def release_fetcher_lease(owner):
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM meta WHERE key = 'fetcher_lease' AND json_extract(value, '$.owner') = ?", (owner,))
+
+# اگه lease از دست بره (مثلاً پروسه مدت زیادی معطل مونده و پروسه‌ی دیگه‌ای شروع به دریافت کرده)
+# دریافت این پروسه با stop متوقف می‌شه تا دو پروسه همزمان از یک session استفاده نکنن. پروسه‌ی جدای
+# fetcher (exit_on_loss) کاری جز دریافت نداره و کلاً خارج می‌شه؛ پروسه‌ی serve به جواب دادن ادامه می‌ده
+def fetcher_lease_worker(owner, stop, exit_on_loss=False):
+    while not stop.wait(FETCHER_LEASE_TTL / 3):
+        try:
+            held = acquire_fetcher_lease(owner)
+        except sqlite3.Error as e:
+            print(f"خطا در تمدید lease دریافت: {e}")
             continue
+        if not held:
+            if exit_on_loss:
+                print("lease دریافت در اختیار پروسه‌ی دیگه‌ای است؛ خروج")
+                os._exit(1)
+            print("lease دریافت در اختیار پروسه‌ی دیگه‌ای است؛ دریافت در این پروسه متوقف شد")
+            stop.set()
 
-    print(f"تعداد آگهی‌های پردازش‌شده: {len(cars)}")
-    df = pd.DataFrame(cars)
-    if 'price' not in df.columns:
-        df['price'] = None
-    return df, None
+def fetcher_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
 
-# تابع خوشه‌بندی
-def cluster_cars(df):
-    if 'year' not in df.columns or 'price' not in df.columns:
-        df['cluster'] = 'بدون گروه'
-        return df
-
-    df_valid = df.dropna(subset=['year', 'price'])
-    if len(df_valid) <= 1:
-        df['cluster'] = 'بدون گروه'
-        return df
-
-    X = df_valid[['year', 'price']].values
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-
-    kmeans = KMeans(n_clusters=3, random_state=0).fit(X_scaled)
-    labels = kmeans.labels_
-
-    df_valid = df_valid.copy()
-    df_valid['label'] = labels
-    cluster_summary = df_valid.groupby('label').agg({'year': 'mean', 'price': 'mean'}).reset_index()
-
-    cluster_labels = []
-    for label in range(3):
-        year_mean = int(cluster_summary.loc[cluster_summary['label'] == label, 'year'].iloc[0])
-        price_mean = int(cluster_summary.loc[cluster_summary['label'] == label, 'price'].iloc[0])
-        if year_mean >= 1402 and price_mean > 1500:
-            cluster_labels.append("ماشین‌های جدید و گران")
-        elif year_mean <= 1398:
-            cluster_labels.append("ماشین‌های قدیمی و ارزان")
+# دریافت پیام‌ها در یک thread پس‌زمینه: تا وقتی پروسه‌ی دیگه‌ای lease رو داره منتظر می‌مونه و هر
+# FETCHER_LEASE_TTL/3 ثانیه دوباره امتحان می‌کنه، پس اگه اون پروسه بسته بشه این یکی جاش رو می‌گیره.
+# lease موقع خروج عادی (و SIGTERM در run_fetcher) آزاد می‌شه. اگه lease از دست بره دریافت متوقف می‌شه
+# و thread دوباره منتظر lease می‌مونه
+def start_fetcher(live=False, exit_on_loss=False):
+    owner = fetcher_owner()
+    atexit.register(release_fetcher_lease, owner)
+
+    def run():
+        while True:
+            waiting = False
+            while True:
+                try:
+                    if acquire_fetcher_lease(owner):
+                        break
+                except sqlite3.Error as e:
+                    print(f"خطا در گرفتن lease دریافت: {e}")
+                if not waiting:
+                    print("پروسه‌ی دیگه‌ای در حال دریافت پیام‌هاست؛ این پروسه تا آزاد شدن lease فقط از پایگاه‌داده می‌خونه")
+                    waiting = True
+                time.sleep(FETCHER_LEASE_TTL / 3)
+            if waiting:
+                print("lease دریافت گرفته شد؛ دریافت پیام‌ها در این پروسه شروع شد")
+            stop = threading.Event()
+            threading.Thread(target=fetcher_lease_worker, args=(owner, stop, exit_on_loss), name='fetcher-lease',
+                             daemon=True).start()
+            start_ingestion(live, stop).join()
+
+    thread = threading.Thread(target=run, name='fetcher', daemon=True)
+    thread.start()
+    return thread
+
+# پروسه‌ی جدای دریافت (python main.py fetcher): تنها پروسه‌ای که به تلگرام وصل می‌شه و در
+# پایگاه‌داده می‌نویسه؛ هر تعداد پروسه‌ی وب (gunicorn) فقط از پایگاه‌داده می‌خونن
+# پروسه‌ی fetcher سرور وب نداره؛ با metrics_port متریک‌های دریافت (همون metrics.render()) روی
+# http://<host>:<port>/metrics جدا در دسترس هستن. اگه METRICS_DIR همون پوشه‌ی workerهای وب باشه،
+# متریک‌های fetcher در /metrics وب هم جمع می‌شن
+FETCHER_METRICS_PORT = None
+
+def start_metrics_server(port):
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print(f"متریک‌های fetcher روی پورت {server.server_address[1]} (/metrics)")
+    return server
+
+def run_fetcher(live=False, metrics_port=FETCHER_METRICS_PORT):
+    start_metrics_writer()
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    load_classifier()
+    # با SIGTERM هم مثل Ctrl+C خارج شو تا lease در atexit آزاد بشه
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    thread = start_fetcher(live, exit_on_loss=True)
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        pass
+
+# گرم کردن پروسه در پس‌زمینه تا اولین درخواست‌ها منتظر نمونن؛ /ready تا پایان این مرحله 503 برمی‌گردونه.
+# (اسم، تابع بارگذاری، فقط برای پروسه‌ای که پیام دریافت می‌کنه): workerهای وب هیچ‌وقت استخراج نمی‌کنن، پس
+# مدل دسته‌بندی و spaCy فقط در پروسه‌ای بارگذاری می‌شن که دریافت هم انجام می‌ده (serve بدون --no-fetch).
+# خطای این دو مرحله فقط ثبت می‌شه و جلوی آماده شدن رو نمی‌گیره؛ مرحله‌های لازم برای جواب دادن
+# (کتابخونه‌ها و جدول آگهی‌ها) هر WARM_UP_RETRY_INTERVAL ثانیه دوباره امتحان می‌شن
+WARM_UP_STAGES = [
+    ('libraries', lambda: (np._load(), pd._load(), MiniBatchKMeans._load()), False),
+    ('classifier', load_classifier, True),
+    ('spacy', get_nlp, True),
+    ('listings', get_snapshot, False),
+]
+WARM_UP_RETRY_INTERVAL = 30
+_readiness = {'started': False, 'ready': False, 'stage': None, 'error': None, 'seconds': {}, 'skipped': {}}
+warm_up_lock = threading.Lock()
+
+def load_warm_up_stage(stage, load):
+    try:
+        load()
+        return True
+    except Exception as e:
+        _readiness['error'] = f"{stage}: {e}"
+        print(f"خطا در آماده‌سازی ({stage}): {e}")
+        return False
+
+def warm_up(ingest=False):
+    for stage, load, ingest_only in WARM_UP_STAGES:
+        if ingest_only and not ingest:
+            continue
+        _readiness['stage'] = stage
+        start = time.perf_counter()
+        while not load_warm_up_stage(stage, load):
+            if ingest_only:
+                _readiness['skipped'][stage] = _readiness['error']
+                break
+            time.sleep(WARM_UP_RETRY_INTERVAL)
         else:
-            cluster_labels.append("ماشین‌های متوسط")
+            _readiness['seconds'][stage] = round(time.perf_counter() - start, 3)
+        # error فقط خطای مرحله‌ای رو نشون می‌ده که هنوز جلوی آماده شدن رو گرفته
+        _readiness['error'] = None
+    _readiness.update(ready=True, stage=None)
+    metrics.set('car_filter_ready', 1)
+    print(f"سرور آماده است: {_readiness['seconds']}")
+    return True
 
-    df_valid['cluster'] = [cluster_labels[label] for label in labels]
-    df = df.merge(df_valid[['cluster']], left_index=True, right_index=True, how='left')
-    df['cluster'] = df['cluster'].fillna('بدون گروه')
-    return df
+# فقط یک بار در هر پروسه اجرا می‌شه (پروسه‌های gunicorn با اولین درخواست گرم می‌شن)
+def start_warm_up(ingest=False):
+    with warm_up_lock:
+        if _readiness['started']:
+            return None
+        _readiness['started'] = True
+    thread = threading.Thread(target=warm_up, args=(ingest,), name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+# زمان import این فایل (بدون کتابخونه‌های سنگین)؛ python main.py import-time
+IMPORT_TIME_BUDGET = 0.5
+
+def measure_import_time(budget=IMPORT_TIME_BUDGET, top=15):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stderr)
+        return None
+
+    # خروجی -X importtime: «import time: self [us] | cumulative | imported package»
+    modules = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((int(parts[1]), parts[2].strip()))
+    for cumulative, module in sorted(modules, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>9.1f} ms  {module}")
+    print(f"زمان کل اجرای پروسه با import main: {seconds:.3f}s (بودجه: {budget}s)")
+    return seconds
+
+# پردازش دوباره‌ی فایل‌های خروجی پیام‌ها (مثل messages.txt) بدون تلگرام: python main.py replay
+# هر رکورد با «کانال||متن» شروع می‌شه و می‌تونه چند خط ادامه داشته باشه
+DUMP_RECORD_START = re.compile(r'^([A-Za-z0-9_]+)\|\|')
+REPLAY_COLUMNS = ['channel', 'raw_text'] + CAR_FIELDS + ['cluster']
+
+# خوندن رکوردها یکی‌یکی، بدون بارگذاری کل فایل در حافظه
+def iter_dump_records(path):
+    channel, lines = None, []
+    with open(path, encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            match = DUMP_RECORD_START.match(line)
+            if match:
+                if channel is not None:
+                    yield channel, '\n'.join(lines)
+                channel, lines = match.group(1), [line[match.end():]]
+            elif channel is not None:
+                lines.append(line)
+    if channel is not None:
+        yield channel, '\n'.join(lines)
+
+def iter_chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# replay پایگاه‌داده‌ی خودش رو داره تا cache استخراجش با listings.db سرور قاطی نشه
+REPLAY_DB_PATH = 'replay.db'
+
+def _init_replay_worker(db_path=REPLAY_DB_PATH, use_cache=True):
+    # اتصال پایگاه‌داده‌ای که از پروسه‌ی اصلی به ارث رسیده نباید در پروسه‌ی فرزند استفاده بشه
+    global _db_local, DB_PATH, EXTRACTION_CACHE
+    _db_local = threading.local()
+    DB_PATH = db_path
+    EXTRACTION_CACHE = use_cache
+
+# پردازش یک تکه از رکوردها در یک پروسه‌ی جدا: دسته‌بندی، استخراج، اعتبارسنجی و خوشه‌بندی
+def replay_chunk(records, classify=True):
+    if classify:
+        relevant = filter_relevant([text for _, text in records])
+        records = [record for record, keep in zip(records, relevant) if keep]
+    df, error = process_messages([f"{channel}||{text}" for channel, text in records])
+    if error:
+        print(error)
+    elif not df.empty:
+        df = cluster_cars(df)
+    return df.reindex(columns=REPLAY_COLUMNS)
+
+# نوشتن تدریجی نتیجه در CSV یا Parquet (بر اساس پسوند فایل خروجی)
+class ReplayWriter:
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self.writer = None
+        self.started = False
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([
+                (column, pa.float64() if column in ('year', 'price', 'mileage') else pa.string())
+                for column in REPLAY_COLUMNS
+            ])
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, schema)
+            df = df.astype({column: 'float64' for column in ('year', 'price', 'mileage')})
+            self.writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        else:
+            df.to_csv(self.path, mode='a' if self.started else 'w', header=not self.started,
+                      index=False, encoding='utf-8-sig' if not self.started else 'utf-8')
+        self.started = True
+        return len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def replay_dump(path, output, workers=None, chunk_size=500, classify=True, db_path=REPLAY_DB_PATH, use_cache=True):
+    workers = workers or os.cpu_count() or 1
+    writer = ReplayWriter(output)
+    total = 0
+    # حداکثر دو تکه برای هر پروسه در صف می‌مونه تا کل فایل یک‌جا خونده نشه
+    with multiprocessing.Pool(workers, initializer=_init_replay_worker, initargs=(db_path, use_cache)) as pool:
+        pending = collections.deque()
+        for chunk in iter_chunks(iter_dump_records(path), chunk_size):
+            pending.append(pool.apply_async(replay_chunk, (chunk, classify)))
+            if len(pending) >= workers * 2:
+                total += writer.write(pending.popleft().get())
+        while pending:
+            total += writer.write(pending.popleft().get())
+    writer.close()
+    print(f"تعداد آگهی‌های نوشته‌شده در {output}: {total}")
+    return total
 
 # قالب HTML با CSS و رفرش خودکار
 HTML_TEMPLATE = '''
@@ -378,73 +2634,91 @@ HTML_TEMPLATE = '''
         tr[status*="مشکوک"] {
             background-color: #ffebee;
         }
+        .pagination {
+            display: flex;
+            justify-content: center;
+            gap: 20px;
+            margin-top: 20px;
+        }
+        .pagination a {
+            color: #d32f2f;
+            text-decoration: none;
+            font-weight: bold;
+        }
         @media (max-width: 768px) {
             .filter-form select, .filter-form input {
                 width: 100%;
             }
         }
     </style>
-    <script>
-        setInterval(function() {
-            location.reload();
-        }, 300000);
-    </script>
 </head>
 <body>
     <div class="container">
         <h1>آگهی‌های خودرو</h1>
-        <form class="filter-form" method="POST">
+        <form class="filter-form" method="GET">
             <label>برند:</label>
             <select name="brand">
                 <option value="">همه</option>
                 {% for brand in brands %}
-                <option value="{{ brand }}">{{ brand }}</option>
+                <option value="{{ brand }}" {% if form.brand == brand %}selected{% endif %}>{{ brand }}</option>
                 {% endfor %}
             </select>
+            <label>جستجو:</label>
+            <input type="text" name="q" placeholder="هر چیزی از متن آگهی" value="{{ form.q or '' }}">
             <label>تیپ:</label>
-            <input type="text" name="model" placeholder="مثال: 206 تیپ 2">
+            <input type="text" name="model" placeholder="مثال: 206 تیپ 2" value="{{ form.model or '' }}">
             <label>رنگ:</label>
             <select name="color">
                 <option value="">همه</option>
                 {% for color in colors %}
-                <option value="{{ color }}">{{ color }}</option>
+                <option value="{{ color }}" {% if form.color == color %}selected{% endif %}>{{ color }}</option>
                 {% endfor %}
             </select>
             <label>حداقل قیمت (میلیون):</label>
-            <input type="number" name="min_price" value="0">
+            <input type="number" name="min_price" value="{{ form.min_price or 0 }}">
             <label>حداکثر قیمت (میلیون):</label>
-            <input type="number" name="max_price" value="10000">
+            <input type="number" name="max_price" value="{{ form.max_price or 10000 }}">
             <label>حداقل سال:</label>
-            <input type="number" name="min_year" value="0">
+            <input type="number" name="min_year" value="{{ form.min_year or 0 }}">
             <label>حداکثر سال:</label>
-            <input type="number" name="max_year" value="1404">
+            <input type="number" name="max_year" value="{{ form.max_year or 1404 }}">
             <label>حداکثر کارکرد (کیلومتر):</label>
-            <input type="number" name="max_mileage" value="1000000">
+            <input type="number" name="max_mileage" value="{{ form.max_mileage or 1000000 }}">
             <label>وضعیت بدنه:</label>
             <select name="body_condition">
                 <option value="">همه</option>
-                <option value="سالم">سالم</option>
-                <option value="رنگ شده">رنگ‌شده</option>
-                <option value="تصادفی">تصادفی</option>
+                {% for value, label in [('سالم', 'سالم'), ('رنگ شده', 'رنگ‌شده'), ('تصادفی', 'تصادفی')] %}
+                <option value="{{ value }}" {% if form.body_condition == value %}selected{% endif %}>{{ label }}</option>
+                {% endfor %}
             </select>
             <label>وضعیت شاسی:</label>
             <select name="chassis_condition">
                 <option value="">همه</option>
-                <option value="سالم">سالم</option>
-                <option value="تعمیر شده">تعمیر‌شده</option>
+                {% for value, label in [('سالم', 'سالم'), ('تعمیر شده', 'تعمیر‌شده')] %}
+                <option value="{{ value }}" {% if form.chassis_condition == value %}selected{% endif %}>{{ label }}</option>
+                {% endfor %}
             </select>
             <label>وضعیت موتور:</label>
             <select name="engine_condition">
                 <option value="">همه</option>
-                <option value="سالم">سالم</option>
-                <option value="تعمیر شده">تعمیر‌شده</option>
+                {% for value, label in [('سالم', 'سالم'), ('تعمیر شده', 'تعمیر‌شده')] %}
+                <option value="{{ value }}" {% if form.engine_condition == value %}selected{% endif %}>{{ label }}</option>
+                {% endfor %}
+            </select>
+            <label>مرتب‌سازی:</label>
+            <select name="sort">
+                {% for value, label in sorts %}
+                <option value="{{ value }}" {% if form.sort == value %}selected{% endif %}>{{ label }}</option>
+                {% endfor %}
             </select>
             <input type="submit" value="فیلتر کن">
         </form>
-        <h2>نتایج:</h2>
+        <h2>نتایج: <span id="total">{{ total }}</span> آگهی</h2>
         <table>
+            <thead>
             <tr>
                 <th>کانال</th>
+                <th>تعداد انتشار</th>
                 <th>برند</th>
                 <th>تیپ</th>
                 <th>رنگ</th>
@@ -456,84 +2730,443 @@ HTML_TEMPLATE = '''
                 <th>وضعیت موتور</th>
                 <th>گروه</th>
                 <th>وضعیت</th>
+                <th>نسبت به بازار</th>
             </tr>
+            </thead>
+            <tbody id="listings">
             {% for car in cars %}
-            <tr status="{{ car.status }}">
-                <td>{{ car.channel|default('بدون اطلاعات') }}</td>
+            {{ render_row(car) }}
+            {% endfor %}
+            </tbody>
+        </table>
+        {% if pages > 1 %}
+        <div class="pagination">
+            {% if page > 1 %}<a href="{{ page_url(page - 1) }}">قبلی</a>{% endif %}
+            <span>صفحه‌ی {{ page }} از {{ pages }}</span>
+            {% if page < pages %}<a href="{{ page_url(page + 1) }}">بعدی</a>{% endif %}
+        </div>
+        {% endif %}
+    </div>
+    <script>
+        // آگهی‌های جدیدی که با فیلترهای همین صفحه می‌خونن از /events می‌رسن و بالای جدول اضافه می‌شن؛
+        // اگه مرورگر EventSource نداشته باشه مثل قبل هر ۵ دقیقه صفحه دوباره بارگذاری می‌شه
+        if (window.EventSource) {
+            {% if events_url %}
+            var listen = function() {
+                var source = new EventSource({{ events_url|tojson }});
+                source.addEventListener('listing', function(event) {
+                    var data = JSON.parse(event.data);
+                    var old = document.querySelector('tr[data-key="' + CSS.escape(data.key) + '"]');
+                    if (old) {
+                        old.remove();
+                    }
+                    document.getElementById('listings').insertAdjacentHTML('afterbegin', data.html);
+                    document.getElementById('total').textContent = data.total;
+                });
+                // اگه سرور ظرفیت نداشت (503) مرورگر خودش دوباره وصل نمی‌شه؛ کمی بعد دوباره امتحان کن
+                source.onerror = function() {
+                    if (source.readyState === EventSource.CLOSED) {
+                        setTimeout(listen, {{ sse_retry * 1000 }});
+                    }
+                };
+            };
+            listen();
+            {% endif %}
+        } else {
+            setInterval(function() {
+                location.reload();
+            }, 300000);
+        }
+    </script>
+</body>
+</html>
+'''
+
+# یک ردیف جدول؛ هم در صفحه و هم برای آگهی‌هایی که از /events می‌رسن استفاده می‌شه
+ROW_TEMPLATE = '''
+            <tr status="{{ car.status }}" data-key="{{ car.channel }}:{{ car.msg_id }}">
+                <td>{{ car.channels|default(car.channel|default('بدون اطلاعات')) }}</td>
+                <td>{{ car.repost_count|default(1) }}</td>
                 <td>{{ car.brand|default('بدون اطلاعات') }}</td>
                 <td>{{ car.model|default('بدون اطلاعات') }}</td>
                 <td>{{ car.color|default('بدون اطلاعات') }}</td>
                 <td>{{ car.year|default('بدون اطلاعات') }}</td>
-                <td>{{ format_price(car.price) }}</td>
+                <td>{{ format_price(car.price|default(none)) }}</td>
                 <td>{{ car.mileage|default('بدون اطلاعات') }}</td>
                 <td>{{ car.body_condition|default('بدون اطلاعات') }}</td>
                 <td>{{ car.chassis_condition|default('بدون اطلاعات') }}</td>
                 <td>{{ car.engine_condition|default('بدون اطلاعات') }}</td>
                 <td>{{ car.cluster|default('بدون گروه') }}</td>
                 <td>{{ car.status|default('درست') }}</td>
-            </tr>
-            {% endfor %}
-        </table>
-    </div>
-</body>
-</html>
-'''
+                <td>{{ '%+d%%'|format((car.deal_score * 100)|round|int) if car.deal_score is defined else '-' }}</td>
+            </tr>'''
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if not _readiness['started']:
+        start_warm_up()
+
+@app.after_request
+def record_request_time(response):
+    elapsed = time.perf_counter() - g.request_start
+    metrics.observe('car_filter_request_seconds', elapsed, endpoint=request.endpoint or 'unknown')
+    if METRICS_TIMING_HEADERS:
+        timings = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in g.get('timings', [])]
+        timings.append(f"total;dur={elapsed * 1000:.2f}")
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# زنده بودن پروسه (بدون وابستگی به مدل‌ها یا پایگاه‌داده)
+@app.route('/healthz')
+def healthz():
+    return jsonify(status='ok')
+
+# آماده بودن برای گرفتن ترافیک؛ تا پایان warm_up کد 503
+@app.route('/ready')
+def ready():
+    body = {'ready': _readiness['ready'], 'stage': _readiness['stage'], 'error': _readiness['error'],
+            'seconds': _readiness['seconds'], 'skipped': _readiness['skipped']}
+    return jsonify(body), 200 if _readiness['ready'] else 503
+
+# زمان کل تولید یک پاسخ stream شده (بعد از فرستادن هدرها تموم می‌شه، پس فقط در /metrics میاد)
+def timed_stream(stage, chunks):
+    with timed(stage):
+        yield from chunks
+
+# قالب صفحه یک بار کامپایل می‌شه
+page_template = app.jinja_env.from_string(HTML_TEMPLATE)
+row_template = app.jinja_env.from_string(ROW_TEMPLATE)
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+FILTER_FIELDS = CATEGORY_FILTERS + ['q', 'model', 'min_price', 'max_price', 'min_year', 'max_year', 'max_mileage']
+PAGE_SORTS = [('', 'پیش‌فرض'), ('-deal_score', 'بهترین قیمت نسبت به بازار'), ('price', 'ارزان‌ترین'),
+              ('-price', 'گران‌ترین'), ('-year', 'جدیدترین مدل'), ('-posted_at', 'جدیدترین آگهی')]
+
+# مقادیر خالی از dict حذف می‌شن تا default قالب نمایش داده بشه
+def render_row(car):
+    return Markup(row_template.render(car={key: value for key, value in car.items() if value is not None},
+                                      format_price=format_price))
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
+    # صفحه هیچ‌وقت مستقیم به تلگرام وصل نمی‌شه؛ آگهی‌ها از پایگاه‌داده‌ی محلی خونده می‌شن
+    # زمان مدل خوشه‌بندی قبل از snapshot خونده می‌شه تا جدول هیچ‌وقت قدیمی‌تر از ETag نباشه
+    cluster_mtime = cluster_model_mtime()
+    version, df, listing_index = get_snapshot()
+    updated_at = get_data_updated_at()
+    if cluster_mtime is not None:
+        cluster_updated_at = datetime.fromtimestamp(cluster_mtime, timezone.utc)
+        updated_at = max(updated_at, cluster_updated_at) if updated_at else cluster_updated_at
+
+    # ETag به نسخه‌ی داده، مدل خوشه‌بندی (برچسب خوشه‌ی آگهی‌ها) و پارامترهای درخواست بستگی داره؛
+    # رفرش خودکار صفحه وقتی چیزی عوض نشده فقط 304 می‌گیره
+    etag = hashlib.sha1(f"{version}|{cluster_mtime}|{sorted(request.values.items(multi=True))}"
+                        .encode('utf-8')).hexdigest()
+    if request.method == 'GET':
+        not_modified = (request.if_none_match.contains(etag) if request.if_none_match
+                        else updated_at is not None and request.if_modified_since is not None
+                        and updated_at.replace(microsecond=0) <= request.if_modified_since)
+        if not_modified:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+    form = {field: request.values.get(field) for field in FILTER_FIELDS}
+    filters = None
+    if any(form.values()):
+        try:
+            filters = parse_filters(request.values)
+        except ValueError:
+            filters = None
+    sort = request.values.get('sort') or None
+    if sort not in dict(PAGE_SORTS):
+        sort = None
+    form['sort'] = sort or ''
+    positions = cached_query(version, df, listing_index, filters, sort)
+
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        messages = loop.run_until_complete(fetch_messages())
-        loop.close()
-    except Exception as e:
-        print(f"خطا در گرفتن پیام‌ها: {e}")
-        messages = []
+        page_size = min(max(int(request.values.get('page_size', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        page = max(int(request.values.get('page', 1)), 1)
+    except ValueError:
+        page_size, page = PAGE_SIZE, 1
+    pages = max((len(positions) + page_size - 1) // page_size, 1)
+    page = min(page, pages)
+    cars = listing_records(df.iloc[positions[(page - 1) * page_size:page * page_size]])
 
-    df, error = process_messages(messages)
-    if error:
-        print(error)
+    def page_url(number):
+        args = {key: value for key, value in request.values.items() if value}
+        args['page'] = number
+        return url_for('index', **args)
+
+    # جدول به صورت stream فرستاده می‌شه و فقط ردیف‌های همین صفحه ساخته می‌شن
+    response = Response(stream_with_context(timed_stream('render', page_template.generate(
+        cars=cars, brands=list(listing_index.lookup['brand']), colors=list(listing_index.lookup['color']),
+        render_row=render_row, form=form, sorts=PAGE_SORTS, total=len(positions), page=page, pages=pages,
+        page_url=page_url,
+        # آگهی‌های جدید فقط به صفحه‌ی اول و بدون مرتب‌سازی (بالای جدول) اضافه می‌شن
+        events_url=url_for('events', **{key: value for key, value in form.items() if value})
+        if page == 1 and not sort else None, sse_retry=SSE_RETRY_AFTER,
+    ))), mimetype='text/html')
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.no_cache = True
+    return response
+
+# Server-Sent Events: آگهی‌هایی که بعد از باز شدن صفحه اضافه یا عوض می‌شن و با فیلترهای
+# query string می‌خونن، به صورت ردیف آماده‌ی جدول فرستاده می‌شن. تغییرات همین پروسه فوری
+# (data_changed) و تغییرات پروسه‌های دیگه هر SSE_POLL_INTERVAL ثانیه با خوندن نسخه‌ی داده پیدا می‌شن
+SSE_POLL_INTERVAL = 2
+SSE_HEARTBEAT = 15
+# هر stream باز یک thread از worker رو نگه می‌داره (gunicorn.conf.py: gthread با THREADS thread)؛
+# بیشتر از این تعداد stream همزمان 503 می‌گیرن تا برای / و /api/cars همیشه thread خالی بمونه
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 8))
+# هر stream بعد از این مدت بسته می‌شه و مرورگر با Last-Event-ID دوباره وصل می‌شه (شاید به worker دیگه)
+SSE_MAX_DURATION = 600
+SSE_RETRY_AFTER = 30
+sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+_sse_state = {'open': 0}
+
+# آگهی‌هایی از جدول فعلی که بعد از نسخه‌ی since اضافه یا عوض شدن و با فیلترها می‌خونن
+def changed_listings(since, filters):
+    keys = load_changed_keys(since)
+    if not keys:
+        return []
+    version, df, listing_index = get_snapshot()
+    positions = cached_query(version, df, listing_index, filters)
+    candidates = positions[np.isin(df['msg_id'].to_numpy()[positions], [msg_id for _, msg_id in keys])]
+    return [
+        {'key': f"{car['channel']}:{car['msg_id']}", 'html': str(render_row(car)), 'total': int(len(positions)), 'listing': car}
+        for car in listing_records(df.iloc[candidates]) if (car['channel'], car['msg_id']) in keys
+    ]
+
+@app.route('/events')
+def events():
+    try:
+        filters = parse_filters(request.args) if any(request.args.get(field) for field in FILTER_FIELDS) else None
+        # مرورگر بعد از قطع شدن اتصال، شناسه‌ی آخرین رویداد (نسخه‌ی داده) رو می‌فرسته
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since') or get_data_version())
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    if not sse_streams.acquire(blocking=False):
+        metrics.inc('car_filter_sse_rejected_total')
+        response = jsonify(error="ظرفیت stream این پروسه پره؛ کمی بعد دوباره امتحان کنید")
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_RETRY_AFTER)
+        return response
+
+    _sse_state['open'] += 1
+    metrics.set('car_filter_sse_streams', _sse_state['open'])
+
+    # ظرفیت با بسته شدن پاسخ آزاد می‌شه، حتی اگه stream هیچ وقت شروع نشده باشه
+    def release():
+        _sse_state['open'] -= 1
+        metrics.set('car_filter_sse_streams', _sse_state['open'])
+        sse_streams.release()
+
+    def stream(since):
+        yield f"retry: {SSE_POLL_INTERVAL * 1000}\nid: {since}\n\n"
+        start = last_beat = time.monotonic()
+        while time.monotonic() - start < SSE_MAX_DURATION:
+            wait_for_data_change(SSE_POLL_INTERVAL)
+            version = get_data_version()
+            if version > since:
+                for update in changed_listings(since, filters):
+                    yield f"id: {version}\nevent: listing\ndata: {json.dumps(update, ensure_ascii=False)}\n\n"
+                since = version
+                last_beat = time.monotonic()
+            elif time.monotonic() - last_beat > SSE_HEARTBEAT:
+                yield ": keepalive\n\n"
+                last_beat = time.monotonic()
+
+    response = Response(stream_with_context(stream(since)), mimetype='text/event-stream')
+    response.call_on_close(release)
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+# cursor صفحه‌بندی: مرتب‌سازی، hash فیلترها و کلید آخرین ردیف صفحه
+def filters_hash(filters):
+    return hashlib.sha1(json.dumps(filters, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+# ترتیب نتیجه‌ی هر جستجو برای cursor: مقدار مرتب‌سازی هر ردیف، ردیف‌های بی‌مقدار (که آخر میان و بینشون
+# کانال و شناسه‌ی پیام صعودیه)، جهت مقدار و جهت کانال و شناسه بین مقدارهای برابر. بدون مرتب‌سازی و جستجوی
+# متنی همه‌ی ردیف‌ها «بی‌مقدار»ن چون ترتیب جدول همون ترتیب (کانال، شناسه‌ی پیام)ه
+def cursor_order(df, listing_index, positions, filters, sort):
+    if not sort:
+        if filters.get('q'):
+            values = listing_index.relevance(filters['q'], positions).astype('float64')
+            return values, np.zeros(len(positions), dtype=bool), True, False
+        return None, np.ones(len(positions), dtype=bool), False, False
+    series = df[sort.lstrip('-')]
+    missing = series.isna().to_numpy()[positions]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        values = series.to_numpy(dtype=object)[positions]
+    elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+        values = series.to_numpy(dtype='datetime64[ns]').view('int64')[positions]
     else:
-        df = cluster_cars(df)
+        values = series.to_numpy(dtype=float, na_value=np.nan)[positions]
+    return values, missing, sort.startswith('-'), sort.startswith('-')
 
-    brands = sorted(df['brand'].dropna().unique()) if not df.empty else []
-    colors = sorted(df['color'].dropna().unique()) if not df.empty else []
-
-    filtered = df
-    if request.method == 'POST':
-        brand = request.form.get('brand')
-        model = request.form.get('model')
-        color = request.form.get('color')
-        min_price = float(request.form.get('min_price', 0))
-        max_price = float(request.form.get('max_price', float('inf')))
-        min_year = int(request.form.get('min_year', 0))
-        max_year = int(request.form.get('max_year', 9999))
-        max_mileage = float(request.form.get('max_mileage', float('inf')))
-        body_condition = request.form.get('body_condition')
-        chassis_condition = request.form.get('chassis_condition')
-        engine_condition = request.form.get('engine_condition')
+# cursor هر صفحه (مقدار مرتب‌سازی، کانال، شناسه‌ی پیام) آخرین ردیفشه نه جایگاهش؛ با عوض شدن داده‌ها
+# صفحه‌ی بعد از اولین ردیفی شروع می‌شه که در ترتیب جدید بعد از اون میاد، پس نه چیزی تکرار می‌شه نه جا میفته
+def cursor_key(df, listing_index, position, filters, sort):
+    values, missing = cursor_order(df, listing_index, np.array([position]), filters, sort)[:2]
+    value = None if missing[0] else values[0]
+    row = df.iloc[position]
+    return [value if value is None or isinstance(value, str) else value.item(), str(row['channel']), int(row['msg_id'])]
 
-        if brand:
-            filtered = filtered[filtered['brand'] == brand]
-        if model:
-            filtered = filtered[filtered['model'].str.contains(model, case=False, na=False)]
-        if color:
-            filtered = filtered[filtered['color'] == color]
-        filtered = filtered[
-            (filtered['price'].fillna(float('inf')) >= min_price) &
-            (filtered['price'].fillna(float('inf')) <= max_price) &
-            (filtered['year'].fillna(0) >= min_year) &
-            (filtered['year'].fillna(0) <= max_year) &
-            (filtered['mileage'].fillna(float('inf')) <= max_mileage)
-        ]
-        if body_condition:
-            filtered = filtered[filtered['body_condition'] == body_condition]
-        if chassis_condition:
-            filtered = filtered[filtered['chassis_condition'] == chassis_condition]
-        if engine_condition:
-            filtered = filtered[filtered['engine_condition'] == engine_condition]
-
-    return render_template_string(HTML_TEMPLATE, cars=filtered.to_dict('records'), brands=brands, colors=colors, format_price=format_price)
+def cursor_start(df, order, positions, key):
+    values, missing, descending, key_descending = order
+    value, channel, msg_id = key
+    channels = df['channel'].to_numpy(dtype=object)[positions]
+    msg_ids = df['msg_id'].to_numpy()[positions]
+    key_after = (channels > channel) | ((channels == channel) & (msg_ids > msg_id))
+    if value is None:
+        after = missing & key_after
+    else:
+        present = ~missing
+        key_before = (channels < channel) | ((channels == channel) & (msg_ids < msg_id))
+        current = values[present]
+        after = missing.copy()
+        after[present] = ((current < value) if descending else (current > value)) \
+            | ((current == value) & (key_before if key_descending else key_after)[present])
+    hits = np.flatnonzero(after)
+    return int(hits[0]) if len(hits) else len(positions)
+
+def encode_cursor(sort, filters, key):
+    payload = json.dumps({'s': sort, 'f': filters_hash(filters), 'k': key}, ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+def decode_cursor(cursor):
+    payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    value, channel, msg_id = payload['k']
+    if not (value is None or isinstance(value, (str, int, float))):
+        raise ValueError("cursor نامعتبر است")
+    return payload['s'], payload['f'], [value, str(channel), int(msg_id)]
+
+# API جستجوی آگهی‌ها: همون فیلترهای فرم به صورت query string، به‌علاوه‌ی sort، limit و cursor
+# با include_text=1 متن کامل آگهی‌های همین صفحه هم از پایگاه‌داده خونده می‌شه
+@app.route('/api/cars')
+def api_cars():
+    version, df, listing_index = get_snapshot()
+    sort = request.args.get('sort') or None
+    try:
+        filters = parse_filters(request.args)
+        limit = min(max(int(request.args.get('limit', API_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+        key = None
+        if request.args.get('cursor'):
+            cursor_sort, cursor_filters, key = decode_cursor(request.args['cursor'])
+            if cursor_sort != sort or cursor_filters != filters_hash(filters):
+                return jsonify(error="cursor مال جستجوی دیگه‌ایه؛ جستجو رو از اول انجام بدید"), 409
+        positions = cached_query(version, df, listing_index, filters, sort)
+        offset = 0
+        if key:
+            offset = cursor_start(df, cursor_order(df, listing_index, positions, filters, sort), positions, key)
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify(error=str(e)), 400
+
+    items = listing_records(df.iloc[positions[offset:offset + limit]])
+    if request.args.get('include_text') in ('1', 'true'):
+        texts = load_raw_texts((item['channel'], item['msg_id']) for item in items)
+        for item in items:
+            item['raw_text'] = texts.get((item['channel'], item['msg_id']))
+    next_cursor = None
+    if offset + limit < len(positions):
+        next_cursor = encode_cursor(sort, filters, cursor_key(df, listing_index, positions[offset + limit - 1],
+                                                              filters, sort))
+    return jsonify(
+        version=version,
+        total=int(len(positions)),
+        items=items,
+        next_cursor=next_cursor,
+    )
+
+# آمار قیمت گروه‌های (برند، مدل، سال): با هر سه پارامتر یک گروه و بدونشون گروه‌های منطبق
+# (پرآگهی‌ترین اول)؛ مدل و سال اختیاری‌ان و مدل باید دقیقاً برابر باشه
+@app.route('/api/prices')
+def api_prices():
+    stats, by_brand = get_price_stats()
+    brand = normalize_text(request.args.get('brand') or '').strip()
+    model = request.args.get('model')
+    try:
+        year = int(request.args['year']) if request.args.get('year') else None
+        limit = min(max(int(request.args.get('limit', API_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    model = price_key(brand, normalize_text(model), 0)[1] if model is not None else None
+
+    if brand and model is not None and year is not None:
+        summary = stats.get((brand, model, year))
+        if summary is None:
+            return jsonify(error="آماری برای این برند، مدل و سال نیست"), 404
+        return jsonify(summary)
+
+    buckets = by_brand.get(brand, []) if brand else list(stats.values())
+    buckets = [summary for summary in buckets
+               if (model is None or summary['model'] == model) and (year is None or summary['year'] == year)]
+    buckets.sort(key=lambda summary: summary['count'], reverse=True)
+    return jsonify(total=len(buckets), items=buckets[:limit])
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="آگهی‌های خودرو از کانال‌های تلگرام")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="اجرای سرور وب و دریافت دوره‌ای پیام‌ها (پیش‌فرض)")
+    serve_parser.add_argument('--live', action='store_true', default=LIVE_MODE,
+                              help="دریافت پیام‌های جدید همون لحظه با events.NewMessage به جای دریافت دوره‌ای")
+    serve_parser.add_argument('--no-fetch', action='store_true',
+                              help="فقط سرور وب؛ دریافت پیام‌ها با پروسه‌ی جدا (python main.py fetcher)")
+    fetcher_parser = subparsers.add_parser('fetcher', help="پروسه‌ی جدای دریافت پیام‌ها برای اجرای چند پروسه‌ی وب")
+    fetcher_parser.add_argument('--live', action='store_true', default=LIVE_MODE,
+                                help="دریافت پیام‌های جدید همون لحظه با events.NewMessage")
+    fetcher_parser.add_argument('--metrics-port', type=int, default=FETCHER_METRICS_PORT,
+                                help="پورت /metrics برای متریک‌های دریافت (پیش‌فرض: خاموش)")
+    subparsers.add_parser('train', help="ترینیگ و ذخیره‌ی مدل دسته‌بندی پیام‌ها")
+    replay_parser = subparsers.add_parser('replay', help="پردازش دوباره‌ی فایل پیام‌ها (مثل messages.txt)")
+    replay_parser.add_argument('dump', help="فایل پیام‌ها با قالب کانال||متن")
+    replay_parser.add_argument('-o', '--output', required=True, help="فایل خروجی (.csv یا .parquet)")
+    replay_parser.add_argument('--workers', type=int, default=None, help="تعداد پروسه‌ها (پیش‌فرض: تعداد هسته‌ها)")
+    replay_parser.add_argument('--chunk-size', type=int, default=500, help="تعداد رکورد در هر تکه")
+    replay_parser.add_argument('--no-classify', action='store_true', help="رد کردن مرحله‌ی تشخیص پیام مرتبط")
+    replay_parser.add_argument('--db', default=REPLAY_DB_PATH, help="پایگاه‌داده‌ی cache استخراج replay")
+    replay_parser.add_argument('--no-cache', action='store_true', help="استخراج همه‌ی پیام‌ها بدون cache")
+    subparsers.add_parser('dedup', help="ساختن دوباره‌ی گروه‌های آگهی‌های تکراری برای همه‌ی داده‌ها")
+    subparsers.add_parser('prices', help="ساختن دوباره‌ی آمار قیمت از روی آگهی‌های ذخیره‌شده")
+    subparsers.add_parser('revalidate', help="اعتبارسنجی دوباره‌ی آگهی‌های ذخیره‌شده با قواعد فعلی")
+    import_parser = subparsers.add_parser('import-time', help="اندازه‌گیری زمان import و مقایسه با بودجه")
+    import_parser.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET, help="بودجه‌ی زمان به ثانیه")
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train_classifier()
+    elif args.command == 'replay':
+        replay_dump(args.dump, args.output, workers=args.workers, chunk_size=args.chunk_size,
+                    classify=not args.no_classify, db_path=args.db, use_cache=not args.no_cache)
+    elif args.command == 'fetcher':
+        run_fetcher(live=args.live, metrics_port=args.metrics_port)
+    elif args.command == 'dedup':
+        rebuild_duplicate_groups()
+    elif args.command == 'prices':
+        rebuild_price_stats()
+    elif args.command == 'revalidate':
+        revalidate_store()
+    elif args.command == 'import-time':
+        seconds = measure_import_time(args.budget)
+        if seconds is None or seconds > args.budget:
+            raise SystemExit(1)
+    else:
+        # در حالت debug، reloader دو پروسه می‌سازه؛ زمان‌بند فقط در پروسه‌ی اصلی سرور اجرا بشه
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            ingest = not getattr(args, 'no_fetch', False)
+            start_warm_up(ingest=ingest)
+            if ingest:
+                start_fetcher(live=getattr(args, 'live', LIVE_MODE))
+        app.run(debug=True)